@@ -1,7 +1,7 @@
 #! /usr/bin/env bash
 set -e
 
-celery -A app.workers.celery worker -l INFO -Ofair &
+celery -A app.workers.celery worker -l INFO -Ofair -Q celery,${FULL_RESOLUTION_QUEUE:-full_resolution} &
 PID=$!
 
 # Listen to the directory for any changes
@@ -12,7 +12,7 @@ inotifywait -r -m /app -e modify,move,create,delete,attrib |
       # if the PID exists, kill it
       kill -s 0 $PID > /dev/null && kill $PID
       sleep 1
-      celery -A app.workers.celery worker -l INFO -Ofair &
+      celery -A app.workers.celery worker -l INFO -Ofair -Q celery,${FULL_RESOLUTION_QUEUE:-full_resolution} &
       PID=$!
     fi
   done
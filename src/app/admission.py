@@ -0,0 +1,327 @@
+"""Admission control for the upload endpoints.
+
+Uploads are refused with 503 while the processing queue is too deep or its
+estimated drain time is too long, and with 429 when a single client exceeds
+its concurrency or byte-rate allowance. Priority tenants bypass every limit.
+
+Clients are told apart by their remote address. The X-Client-Id and
+X-Tenant-Id headers are only honoured from ADMISSION_TRUSTED_PROXIES, the
+gateways that set them. The state is kept per process, every gunicorn worker
+applies the limits on its own.
+"""
+import ipaddress
+import logging
+import math
+import os
+import re
+import threading
+import time
+import urllib.parse
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from app.exceptions import ServiceUnavailable, TooManyRequests
+
+
+@dataclass
+class AdmissionRule:
+    method: str
+    path: "re.Pattern"
+    # refuse while the processing queue is too deep
+    check_queue: bool
+    # count against the client's concurrency and byte rate (Content-Length)
+    charge_client: bool
+
+
+UPLOAD_RULES = [
+    AdmissionRule("POST", re.compile(r"/upload"), True, True),
+    AdmissionRule("POST", re.compile(r"/uploads"), True, True),
+    AdmissionRule("PATCH", re.compile(r"/uploads/[^/]+"), False, True),
+    # finalizing queues the processing, chunks of started uploads are let in
+    AdmissionRule("POST", re.compile(r"/uploads/[^/]+/finalize"), True, False),
+]
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+@dataclass
+class QueueStats:
+    depth: int
+    backlog_seconds: float
+
+
+class BrokerQueueProbe:
+    """Read queue depth and drain rate from the RabbitMQ management API."""
+
+    def __init__(self, management_url: str, queue: str, vhost: str = "/"):
+        self.management_url = management_url.rstrip("/")
+        self.queue = queue
+        self.vhost = vhost
+
+    def __call__(self) -> QueueStats:
+        import requests
+
+        response = requests.get(
+            f"{self.management_url}/api/queues/"
+            f"{urllib.parse.quote(self.vhost, safe='')}/{self.queue}",
+            timeout=2,
+        )
+        response.raise_for_status()
+        data = response.json()
+        depth = data.get("messages", 0)
+        ack_rate = data.get("message_stats", {}).get("ack_details", {}).get("rate", 0)
+        if ack_rate > 0:
+            backlog_seconds = depth / ack_rate
+        else:
+            backlog_seconds = depth * _env_float("ADMISSION_SECONDS_PER_TASK", 10)
+        return QueueStats(depth=depth, backlog_seconds=backlog_seconds)
+
+
+class TaskQueueProbe:
+    """Queue depth as reported by the task backend, for when no management API
+    is available; the drain time is estimated from ADMISSION_SECONDS_PER_TASK."""
+
+    def __init__(self, queue: str):
+        self.queue = queue
+
+    def __call__(self) -> QueueStats:
+        from app.workers.backend import task_backend
+
+        depth = task_backend.queue_depth(self.queue)
+        return QueueStats(
+            depth=depth,
+            backlog_seconds=depth * _env_float("ADMISSION_SECONDS_PER_TASK", 10),
+        )
+
+
+class TokenBucket:
+    """Byte-rate limiter; a single large upload may overdraw the bucket."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def take(self, amount: float) -> float:
+        """Consume amount tokens; return seconds to wait if none are available."""
+        now = time.monotonic()
+        refill = (now - self.updated_at) * self.rate
+        self.tokens = min(self.capacity, self.tokens + refill)
+        self.updated_at = now
+        if self.tokens <= 0:
+            return -self.tokens / self.rate
+        self.tokens -= amount
+        return 0
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        probe=None,
+        probe_interval: float = 5,
+        max_queue_depth: int = 0,
+        max_backlog_seconds: float = 0,
+        max_client_concurrency: int = 0,
+        client_bytes_per_second: float = 0,
+        client_burst_seconds: float = 10,
+        priority_tenants=(),
+        trusted_proxies=(),
+    ):
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.max_queue_depth = max_queue_depth
+        self.max_backlog_seconds = max_backlog_seconds
+        self.max_client_concurrency = max_client_concurrency
+        self.client_bytes_per_second = client_bytes_per_second
+        self.client_burst_seconds = client_burst_seconds
+        self.priority_tenants = set(priority_tenants)
+        self.trusted_proxies = [
+            ipaddress.ip_network(proxy.strip(), strict=False)
+            for proxy in trusted_proxies
+        ]
+
+        self._stats: Optional[QueueStats] = None
+        self._stats_at = 0.0
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        queue = os.getenv("ADMISSION_QUEUE", "celery")
+        if management_url := os.getenv("RABBITMQ_MANAGEMENT_URL"):
+            probe = BrokerQueueProbe(
+                management_url,
+                queue=queue,
+                vhost=os.getenv("ADMISSION_VHOST", "/"),
+            )
+        else:
+            probe = TaskQueueProbe(queue)
+        return cls(
+            probe=probe,
+            probe_interval=_env_float("ADMISSION_PROBE_INTERVAL", 5),
+            max_queue_depth=int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", "0")),
+            max_backlog_seconds=_env_float("ADMISSION_MAX_BACKLOG_SECONDS", 0),
+            max_client_concurrency=int(os.getenv("ADMISSION_CLIENT_CONCURRENCY", "0")),
+            client_bytes_per_second=_env_float("ADMISSION_CLIENT_BYTES_PER_SECOND", 0),
+            client_burst_seconds=_env_float("ADMISSION_CLIENT_BURST_SECONDS", 10),
+            priority_tenants=filter(
+                None, os.getenv("ADMISSION_PRIORITY_TENANTS", "").split(",")
+            ),
+            trusted_proxies=filter(
+                None, os.getenv("ADMISSION_TRUSTED_PROXIES", "").split(",")
+            ),
+        )
+
+    def is_trusted(self, host: Optional[str]) -> bool:
+        """Whether host is a gateway allowed to set the client and tenant headers."""
+        try:
+            address = ipaddress.ip_address(host)
+        except (TypeError, ValueError):
+            return False
+        return any(address in network for network in self.trusted_proxies)
+
+    @property
+    def checks_queue(self) -> bool:
+        return self.probe is not None and (
+            self.max_queue_depth > 0 or self.max_backlog_seconds > 0
+        )
+
+    def queue_stats(self) -> Optional[QueueStats]:
+        """Return cached queue stats, refreshing them every probe_interval seconds."""
+        if time.monotonic() - self._stats_at < self.probe_interval:
+            return self._stats
+        try:
+            self._stats = self.probe()
+        except Exception:
+            # fail open, a broken probe must not take uploads down with it
+            logging.exception("admission queue probe failed")
+            self._stats = None
+        self._stats_at = time.monotonic()
+        return self._stats
+
+    def check_queue(self, stats: Optional[QueueStats]):
+        if stats is None:
+            return
+        retry_after = max(1, math.ceil(min(stats.backlog_seconds, 300)))
+        if self.max_queue_depth and stats.depth >= self.max_queue_depth:
+            raise ServiceUnavailable(
+                f"Processing queue is full ({stats.depth} pending), try again later",
+                retry_after=retry_after,
+            )
+        max_backlog = self.max_backlog_seconds
+        if max_backlog and stats.backlog_seconds >= max_backlog:
+            raise ServiceUnavailable(
+                f"Processing backlog is {int(stats.backlog_seconds)}s, try again later",
+                retry_after=retry_after,
+            )
+
+    def acquire(self, client: str, content_length: int):
+        with self._lock:
+            if (
+                self.max_client_concurrency
+                and self._in_flight.get(client, 0) >= self.max_client_concurrency
+            ):
+                raise TooManyRequests(
+                    "Too many concurrent uploads for this client", retry_after=1
+                )
+            if self.client_bytes_per_second:
+                bucket = self._buckets.setdefault(
+                    client,
+                    TokenBucket(
+                        self.client_bytes_per_second,
+                        self.client_bytes_per_second * self.client_burst_seconds,
+                    ),
+                )
+                if wait := bucket.take(content_length):
+                    raise TooManyRequests(
+                        "Upload byte rate exceeded for this client",
+                        retry_after=max(1, math.ceil(wait)),
+                    )
+            self._in_flight[client] = self._in_flight.get(client, 0) + 1
+
+    def release(self, client: str):
+        with self._lock:
+            remaining = self._in_flight.get(client, 1) - 1
+            if remaining > 0:
+                self._in_flight[client] = remaining
+            else:
+                self._in_flight.pop(client, None)
+
+
+admission_controller = AdmissionController.from_env()
+
+
+def _gateway_header(request: Request, name: str) -> Optional[str]:
+    host = request.client.host if request.client else None
+    if admission_controller.is_trusted(host):
+        return request.headers.get(name)
+    return None
+
+
+def _client_key(request: Request) -> str:
+    if client_id := _gateway_header(request, "X-Client-Id"):
+        return client_id
+    return request.client.host if request.client else "unknown"
+
+
+async def admit(request: Request, rule: AdmissionRule) -> Optional[str]:
+    """Check the admission limits, return the client holding an upload slot."""
+    tenant = _gateway_header(request, "X-Tenant-Id")
+    if tenant in admission_controller.priority_tenants:
+        return None
+
+    if rule.check_queue and admission_controller.checks_queue:
+        stats = await run_in_threadpool(admission_controller.queue_stats)
+        admission_controller.check_queue(stats)
+
+    if not rule.charge_client:
+        return None
+    client = _client_key(request)
+    admission_controller.acquire(
+        client, int(request.headers.get("Content-Length", "0") or 0)
+    )
+    return client
+
+
+class AdmissionMiddleware:
+    """ASGI middleware guarding the upload endpoints.
+
+    Admission runs before the route reads the request body, so refused uploads
+    are not received first.
+    """
+
+    def __init__(self, app, rules=UPLOAD_RULES):
+        self.app = app
+        self.rules = rules
+
+    async def __call__(self, scope, receive, send):
+        rule = scope["type"] == "http" and next(
+            (
+                rule
+                for rule in self.rules
+                if rule.method == scope["method"] and rule.path.fullmatch(scope["path"])
+            ),
+            None,
+        )
+        if not rule:
+            return await self.app(scope, receive, send)
+        try:
+            client = await admit(Request(scope), rule)
+        except HTTPException as exc:
+            response = JSONResponse(
+                {"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers
+            )
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if client is not None:
+                admission_controller.release(client)
@@ -0,0 +1,318 @@
+"""Two-tier cache for download responses.
+
+The first tier is a per-process LRU bounded by the size of the cached
+payloads. The second tier is a directory shared by every process on the host
+(web and worker), which also carries invalidation markers so that an edit made
+in one process is seen by the in-memory tier of all others. Without the shared
+directory the in-memory tier is only used by single process deployments
+(WEB_CONCURRENCY=1), as invalidations would not reach the other workers.
+"""
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+
+def _payload_size(value) -> int:
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_payload_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_payload_size(v) for v in value)
+    return 8
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).decode("ascii")
+    return getattr(value, "value", str(value))
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class MemoryTier:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._keys_by_media: Dict[str, Set[str]] = {}
+        # content hash of the cached version of each media
+        self.versions: Dict[str, str] = {}
+
+    def get(self, key: str) -> Optional[tuple]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, media_id: str, key: str, value: Dict, stored_at: float):
+        size = _payload_size(value)
+        if size > self.max_bytes:
+            return
+        self.pop(key)
+        self._entries[key] = (media_id, value, stored_at, size)
+        self._keys_by_media.setdefault(media_id, set()).add(key)
+        self.size += size
+        while self.size > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self.pop(oldest_key)
+
+    def pop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        media_id, _, _, size = entry
+        self.size -= size
+        keys = self._keys_by_media.get(media_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_media[media_id]
+                self.versions.pop(media_id, None)
+
+    def invalidate(self, media_id: str):
+        for key in list(self._keys_by_media.get(media_id, ())):
+            self.pop(key)
+        self.versions.pop(media_id, None)
+
+
+class DiskTier:
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._writes = 0
+        os.makedirs(os.path.join(directory, "invalidated"), exist_ok=True)
+
+    def _media_dir(self, media_id: str) -> str:
+        return os.path.join(self.directory, media_id)
+
+    def _entry_path(self, media_id: str, key: str) -> str:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self._media_dir(media_id), f"{digest}.json")
+
+    def _marker_path(self, media_id: str) -> str:
+        return os.path.join(self.directory, "invalidated", media_id)
+
+    def _count_write(self):
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def invalidated_at(self, media_id: str) -> float:
+        try:
+            return os.stat(self._marker_path(media_id)).st_mtime
+        except FileNotFoundError:
+            return 0.0
+
+    def version(self, media_id: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self._media_dir(media_id), "version")) as f:
+                return f.read() or None
+        except FileNotFoundError:
+            return None
+
+    def get(self, media_id: str, key: str) -> Optional[tuple]:
+        path = self._entry_path(media_id, key)
+        try:
+            stored_at = os.stat(path).st_mtime
+            with open(path) as f:
+                value = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return value, stored_at
+
+    def _write(self, path: str, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            write(f)
+        os.replace(tmp_path, path)
+
+    def set(self, media_id: str, version: str, key: str, value: Dict):
+        self._write(
+            os.path.join(self._media_dir(media_id), "version"),
+            lambda f: f.write(version),
+        )
+        self._write(
+            self._entry_path(media_id, key),
+            lambda f: json.dump(value, f, default=_json_default),
+        )
+        self._count_write()
+
+    def invalidate(self, media_id: str):
+        with open(self._marker_path(media_id), "w"):
+            pass
+        shutil.rmtree(self._media_dir(media_id), ignore_errors=True)
+        self._count_write()
+
+    def prune(self):
+        """Drop markers older than the TTL, then the least recently written
+        entries until under max_bytes."""
+        # entries stored before an expired marker are expired themselves
+        expired = time.time() - self.ttl
+        markers_dir = os.path.join(self.directory, "invalidated")
+        for media_id in os.listdir(markers_dir):
+            path = os.path.join(markers_dir, media_id)
+            try:
+                if os.stat(path).st_mtime < expired:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+
+        entries = []
+        for media_id in os.listdir(self.directory):
+            media_dir = self._media_dir(media_id)
+            if media_id == "invalidated" or not os.path.isdir(media_dir):
+                continue
+            names = os.listdir(media_dir)
+            if not names:
+                with contextlib.suppress(OSError):
+                    os.rmdir(media_dir)
+            for name in names:
+                path = os.path.join(media_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            _remove_quietly(path)
+            total -= size
+
+
+class ResponseCache:
+    """Download response cache keyed by media id, content hash, source and pages.
+
+    The content hash of the cached version of a media is kept with its entries,
+    so hits never touch the database, and entries of another version of the
+    document can never be served for it.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float,
+        directory: Optional[str] = None,
+        disk_max_bytes: int = 0,
+    ):
+        self.ttl = ttl
+        self.memory = MemoryTier(max_bytes) if max_bytes > 0 else None
+        self.disk = DiskTier(directory, disk_max_bytes, ttl) if directory else None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory is not None or self.disk is not None
+
+    @staticmethod
+    def key(media_id: str, version: str, source: str, idx: List[int]) -> str:
+        return f"{media_id}:{version}:{source}:{','.join(map(str, idx))}"
+
+    def _version(self, media_id: str) -> Optional[str]:
+        if self.memory is not None:
+            with self._lock:
+                version = self.memory.versions.get(media_id)
+            if version is not None:
+                return version
+        if self.disk is not None:
+            return self.disk.version(media_id)
+        return None
+
+    def _is_fresh(self, media_id: str, stored_at: float) -> bool:
+        if time.time() - stored_at > self.ttl:
+            return False
+        return self.disk is None or self.disk.invalidated_at(media_id) < stored_at
+
+    def get(self, media_id: str, source: str, idx: List[int]) -> Optional[Dict]:
+        if (version := self._version(media_id)) is None:
+            return None
+        key = self.key(media_id, version, source, idx)
+        if self.memory is not None:
+            with self._lock:
+                entry = self.memory.get(key)
+            if entry is not None:
+                _, value, stored_at, _ = entry
+                if self._is_fresh(media_id, stored_at):
+                    return value
+                with self._lock:
+                    self.memory.pop(key)
+
+        if self.disk is not None:
+            entry = self.disk.get(media_id, key)
+            if entry is not None and self._is_fresh(media_id, entry[1]):
+                value, stored_at = entry
+                if self.memory is not None:
+                    with self._lock:
+                        self.memory.versions[media_id] = version
+                        self.memory.set(media_id, key, value, stored_at)
+                return value
+        return None
+
+    def set(
+        self, media_id: str, version: str, source: str, idx: List[int], value: Dict
+    ):
+        key = self.key(media_id, version, source, idx)
+        stored_at = time.time()
+        if self.memory is not None:
+            with self._lock:
+                if self.memory.versions.get(media_id) != version:
+                    self.memory.invalidate(media_id)
+                    self.memory.versions[media_id] = version
+                self.memory.set(media_id, key, value, stored_at)
+        if self.disk is not None:
+            try:
+                self.disk.set(media_id, version, key, value)
+            except OSError:
+                logging.exception(f"failed to write response cache entry {key}")
+
+    def invalidate(self, media_id: str):
+        if self.memory is not None:
+            with self._lock:
+                self.memory.invalidate(media_id)
+        if self.disk is not None:
+            try:
+                self.disk.invalidate(media_id)
+            except OSError:
+                logging.exception(f"failed to invalidate response cache for {media_id}")
+
+
+def _create_response_cache() -> ResponseCache:
+    max_bytes = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+    directory = os.getenv("RESPONSE_CACHE_DIR", "/scratch/response_cache") or None
+    if directory is not None:
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            logging.exception(f"cannot use RESPONSE_CACHE_DIR {directory}")
+            directory = None
+    if directory is None and os.getenv("WEB_CONCURRENCY") != "1":
+        logging.warning(
+            "RESPONSE_CACHE_DIR is unset, the response cache is disabled as edits "
+            "would not invalidate it in the other web workers"
+        )
+        max_bytes = 0
+    return ResponseCache(
+        max_bytes=max_bytes,
+        ttl=float(os.getenv("RESPONSE_CACHE_TTL", "300")),
+        directory=directory,
+        disk_max_bytes=int(os.getenv("RESPONSE_CACHE_DISK_MAX_BYTES", str(1024**3))),
+    )
+
+
+response_cache = _create_response_cache()
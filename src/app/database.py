@@ -1,28 +1,70 @@
+import itertools
+import logging
 import os
+import time
 import urllib.parse
+from typing import Callable, List, Optional
 
-from sqlalchemy.engine import create_engine
+from sqlalchemy.engine import Engine, create_engine
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import DeclarativeMeta, Session, sessionmaker
 
 
+class Replica:
+    def __init__(self, url: str, pool_size: int, max_overflow: int):
+        self.engine = create_engine(
+            url,
+            max_overflow=max_overflow,
+            pool_recycle=3600,
+            pool_size=pool_size,
+            pool_pre_ping=True,
+        )
+        self.session_maker = sessionmaker(autocommit=False, bind=self.engine)
+        self.unhealthy_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+
 class DatabaseInstance:
     _base: DeclarativeMeta = None
 
-    def __init__(self):
+    def __init__(self, replica_urls: Optional[List[str]] = None):
         self._base = declarative_base()
         self._engine = create_engine(
             self.get_database_url(),
-            max_overflow=20,
+            max_overflow=int(os.getenv("POSTGRES_MAX_OVERFLOW", "20")),
             pool_recycle=3600,
-            pool_size=2,
+            pool_size=int(os.getenv("POSTGRES_POOL_SIZE", "2")),
         )
         self._session_maker = sessionmaker(autocommit=False, bind=self._engine)
 
+        if replica_urls is None:
+            replica_urls = self.get_replica_urls()
+        self._replicas = [
+            Replica(
+                url,
+                pool_size=int(os.getenv("POSTGRES_REPLICA_POOL_SIZE", "5")),
+                max_overflow=int(os.getenv("POSTGRES_REPLICA_MAX_OVERFLOW", "20")),
+            )
+            for url in replica_urls
+        ]
+        self._replica_cycle = itertools.cycle(self._replicas)
+        self.replica_cooldown = float(os.getenv("POSTGRES_REPLICA_COOLDOWN", "30"))
+        # processes that read what they are about to write (the workers) keep
+        # every read on the primary
+        self.reads_from_replicas = bool(self._replicas)
+
     @property
     def base(self) -> DeclarativeMeta:
         return self._base
 
+    @property
+    def engine(self) -> Engine:
+        return self._engine
+
     @staticmethod
     def get_database_url() -> str:
         db_name = os.getenv("POSTGRES_DB")
@@ -35,9 +77,63 @@ class DatabaseInstance:
 
         return f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}?sslmode={db_ssl_mode}"
 
+    @staticmethod
+    def get_replica_urls() -> List[str]:
+        return [
+            url.strip()
+            for url in os.getenv("POSTGRES_REPLICA_URLS", "").split(",")
+            if url.strip()
+        ]
+
     def initialize_session(self) -> Session:
         return self._session_maker()
 
+    def _healthy_replica(self) -> Optional[Replica]:
+        for _ in range(len(self._replicas)):
+            replica = next(self._replica_cycle)
+            if replica.healthy:
+                return replica
+        return None
+
+    def run_read(
+        self,
+        query: Callable[[Session], object],
+        key: Optional[str] = None,
+        settled: Optional[Callable[[Session], bool]] = None,
+    ):
+        """Run a read-only query on a replica when one can serve it.
+
+        A lookup of key is only answered by a replica when settled(session),
+        a narrow query run on the replica first, tells the rows exist and are
+        in a state later writes do not change, so the replica cannot be behind
+        on them whichever process wrote them. Otherwise, and when no replica
+        is configured or healthy or the replica fails, the query runs on the
+        primary session, and the full rows are only loaded once.
+
+        Replica results are detached from their (closed) session: loaded
+        columns can be read, but they cannot lazy-load, refresh or be flushed.
+        Writes go through the model classmethods, which update by id.
+        """
+        if self.reads_from_replicas:
+            replica = self._healthy_replica()
+            if replica is not None:
+                session = replica.session_maker()
+                try:
+                    if key is None or (settled is not None and settled(session)):
+                        return query(session)
+                except OperationalError as e:
+                    logging.warning(f"replica read failed, using the primary: {e}")
+                    replica.unhealthy_until = time.monotonic() + self.replica_cooldown
+                finally:
+                    session.close()
+
+        session = get_db_session()
+        try:
+            return query(session)
+        except Exception as e:
+            session.rollback()
+            raise e
+
     def delete_all_tables_and_metadata(self):
         # Get a session from the session maker
         session = self.initialize_session()
@@ -4,3 +4,21 @@ from fastapi import HTTPException, status
 class BadRequest(HTTPException):
     def __init__(self, message):
         super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
+
+
+class TooManyRequests(HTTPException):
+    def __init__(self, message, retry_after: int):
+        super().__init__(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=message,
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class ServiceUnavailable(HTTPException):
+    def __init__(self, message, retry_after: int):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=message,
+            headers={"Retry-After": str(retry_after)},
+        )
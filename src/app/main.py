@@ -1,13 +1,13 @@
-from alembic.runtime.migration import MigrationContext
 from fastapi import FastAPI
 from fastapi.middleware import Middleware
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.routing import APIRoute
 from router import router
-from sqlalchemy import create_engine
 
+from app import profiling
+from app.admission import AdmissionMiddleware
 from app.database import db_instance
-from app.workers.celery import celery_app
+from app.workers.backend import task_backend
 from app.workers.tasks import run_test_task
 
 
@@ -17,19 +17,12 @@ async def root():
 
 # Health checks
 def get_alembic_version():
-    db_url = db_instance.get_database_url()
-    engine = create_engine(db_url)
-    conn = engine.connect()
-    context = MigrationContext.configure(conn)
-    return context.get_current_revision()
+    # alembic is only needed by the healthcheck, keep it out of startup
+    from alembic.runtime.migration import MigrationContext
 
-
-def celery_healthcheck():
-    """Check if celery workers are alive with ping"""
-    if celery_response := celery_app.control.ping(timeout=0.5):
-        return celery_response
-    else:
-        return "No celery tasks currently active."
+    with db_instance.engine.connect() as conn:
+        context = MigrationContext.configure(conn)
+        return context.get_current_revision()
 
 
 async def celery_send_test_task():
@@ -42,10 +35,11 @@ async def celery_send_test_task():
 
 async def healthcheck():
     """Basic healthcheck endpoint.
-    Connects to DB for alembic version string and pings Celery worker(s) for 'pong' alive response.
+    Connects to DB for alembic version string and pings Celery worker(s) for 'pong' alive response,
+    or reports the queue of the local task backend.
     """
     alembic_revision = get_alembic_version()
-    celery_response = celery_healthcheck()
+    celery_response = task_backend.status()
 
     return {
         "alembic_version": alembic_revision,
@@ -59,8 +53,20 @@ routes = [
     APIRoute("/test-task", endpoint=celery_send_test_task, methods=["GET"]),
 ]
 
-middleware = Middleware(CORSMiddleware)
+middleware = [Middleware(CORSMiddleware), Middleware(AdmissionMiddleware)]
+
+app = FastAPI(routes=routes, middleware=middleware)
+profiling.install(app)
+
+
+@app.on_event("startup")
+async def start_task_backend():
+    await task_backend.start()
+
+
+@app.on_event("shutdown")
+async def stop_task_backend():
+    await task_backend.stop()
 
-app = FastAPI(routes=routes, middleware=[middleware])
 
 app.include_router(router)
@@ -0,0 +1,36 @@
+"""add task outbox
+
+Revision ID: 2c7b9e04f1a6
+Revises: 9a41d7c3e852
+Create Date: 2026-10-19 11:48:02.117930
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "2c7b9e04f1a6"
+down_revision = "9a41d7c3e852"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "task_outbox",
+        sa.Column("id", sa.String(length=255), nullable=False),
+        sa.Column("task_name", sa.String(length=255), nullable=False),
+        sa.Column("args", sa.Text(), nullable=False),
+        sa.Column("headers", sa.Text(), nullable=False),
+        sa.Column("options", sa.Text(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_task_outbox_created_at"), "task_outbox", ["created_at"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_task_outbox_created_at"), table_name="task_outbox")
+    op.drop_table("task_outbox")
@@ -0,0 +1,75 @@
+"""add blank pages
+
+Revision ID: 3f8a6d2e0b47
+Revises: 7d3e5a9c1b20
+Create Date: 2026-10-19 15:02:13.517204
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+revision = "3f8a6d2e0b47"
+down_revision = "7d3e5a9c1b20"
+branch_labels = None
+depends_on = None
+
+COLUMNS = (
+    "file_name, raw_file, file_type, processed_files, preview_files, content_hash, "
+    "blank_pages"
+)
+
+
+def _partitioned_copy_exists() -> bool:
+    return (
+        op.get_bind()
+        .execute(sa.text("SELECT to_regclass('media_info_partitioned')"))
+        .scalar()
+        is not None
+    )
+
+
+def _replace_sync_function(columns: str):
+    updates = ", ".join(
+        f"{column} = EXCLUDED.{column}" for column in columns.split(", ")
+    )
+    new_values = ", ".join(f"NEW.{column}" for column in columns.split(", "))
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION media_info_sync_partitioned() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM media_info_partitioned WHERE id = OLD.id::uuid;
+                RETURN OLD;
+            END IF;
+            INSERT INTO media_info_partitioned (id, {columns})
+            VALUES (NEW.id::uuid, {new_values})
+            ON CONFLICT (id) DO UPDATE SET {updates};
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+
+
+def upgrade():
+    op.add_column(
+        "media_info",
+        sa.Column("blank_pages", postgresql.ARRAY(sa.Integer()), nullable=True),
+    )
+    if not _partitioned_copy_exists():
+        return
+    # the online partitioning migration is in progress, keep mirroring every column
+    op.add_column(
+        "media_info_partitioned",
+        sa.Column("blank_pages", postgresql.ARRAY(sa.Integer()), nullable=True),
+    )
+    _replace_sync_function(COLUMNS)
+
+
+def downgrade():
+    if _partitioned_copy_exists():
+        _replace_sync_function(COLUMNS.replace(", blank_pages", ""))
+        op.drop_column("media_info_partitioned", "blank_pages")
+    op.drop_column("media_info", "blank_pages")
@@ -0,0 +1,27 @@
+"""add preview files
+
+Revision ID: 5e0f1c2a7b3d
+Revises: 123d6667a099
+Create Date: 2026-10-19 10:12:41.204118
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+revision = "5e0f1c2a7b3d"
+down_revision = "123d6667a099"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "media_info",
+        sa.Column("preview_files", postgresql.ARRAY(sa.LargeBinary()), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_column("media_info", "preview_files")
@@ -0,0 +1,133 @@
+"""hash partitioned media_info with uuid keys
+
+An empty media_info (a new deployment) is recreated hash partitioned right
+away. Otherwise media_info_partitioned is created next to the live table and
+every write mirrored into it with a trigger; existing rows are copied and the
+tables swapped online with `python -m app.scripts.partition_media_info
+copy|swap`.
+
+Revision ID: 7d3e5a9c1b20
+Revises: 2c7b9e04f1a6
+Create Date: 2026-10-19 13:20:55.806413
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+revision = "7d3e5a9c1b20"
+down_revision = "2c7b9e04f1a6"
+branch_labels = None
+depends_on = None
+
+COLUMNS = "file_name, raw_file, file_type, processed_files, preview_files, content_hash"
+# part of the schema from here on, changing it means partitioning again
+PARTITION_COUNT = 16
+
+
+def _create_media_info(table: str, id_type, partitioned: bool):
+    op.create_table(
+        table,
+        sa.Column("id", id_type, nullable=False),
+        sa.Column("file_name", sa.String(), nullable=True),
+        sa.Column("raw_file", sa.LargeBinary(), nullable=False),
+        sa.Column(
+            "file_type",
+            postgresql.ENUM(name="filetype", create_type=False),
+            nullable=False,
+        ),
+        sa.Column("processed_files", postgresql.ARRAY(sa.LargeBinary()), nullable=True),
+        sa.Column("preview_files", postgresql.ARRAY(sa.LargeBinary()), nullable=True),
+        sa.Column("content_hash", sa.String(length=64), nullable=True),
+        sa.PrimaryKeyConstraint("id", name=f"{table}_pkey"),
+        **({"postgresql_partition_by": "HASH (id)"} if partitioned else {}),
+    )
+    if partitioned:
+        for remainder in range(PARTITION_COUNT):
+            op.execute(
+                f"CREATE TABLE {table}_p{remainder} PARTITION OF {table} "
+                f"FOR VALUES WITH (MODULUS {PARTITION_COUNT}, REMAINDER {remainder})"
+            )
+    op.create_index(f"ix_{table}_content_hash", table, ["content_hash"], unique=False)
+
+
+def _media_info_is_empty() -> bool:
+    bind = op.get_bind()
+    # no row can be written between the check and the table being replaced
+    bind.execute(sa.text("LOCK TABLE media_info IN ACCESS EXCLUSIVE MODE"))
+    return not bind.execute(
+        sa.text("SELECT EXISTS (SELECT 1 FROM media_info)")
+    ).scalar()
+
+
+def _partitioned_copy_exists() -> bool:
+    return (
+        op.get_bind()
+        .execute(sa.text("SELECT to_regclass('media_info_partitioned')"))
+        .scalar()
+        is not None
+    )
+
+
+def upgrade():
+    if _media_info_is_empty():
+        op.drop_table("media_info")
+        _create_media_info("media_info", postgresql.UUID(), partitioned=True)
+        return
+
+    _create_media_info("media_info_partitioned", postgresql.UUID(), partitioned=True)
+    updates = ", ".join(
+        f"{column} = EXCLUDED.{column}" for column in COLUMNS.split(", ")
+    )
+    new_values = ", ".join(f"NEW.{column}" for column in COLUMNS.split(", "))
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION media_info_sync_partitioned() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM media_info_partitioned WHERE id = OLD.id::uuid;
+                RETURN OLD;
+            END IF;
+            INSERT INTO media_info_partitioned (id, {COLUMNS})
+            VALUES (NEW.id::uuid, {new_values})
+            ON CONFLICT (id) DO UPDATE SET {updates};
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER media_info_sync_partitioned
+        AFTER INSERT OR UPDATE OR DELETE ON media_info
+        FOR EACH ROW EXECUTE FUNCTION media_info_sync_partitioned()
+        """
+    )
+
+
+def downgrade():
+    if _partitioned_copy_exists():
+        # the online migration was not swapped yet, media_info is still the old table
+        op.execute("DROP TRIGGER IF EXISTS media_info_sync_partitioned ON media_info")
+        op.execute("DROP FUNCTION IF EXISTS media_info_sync_partitioned()")
+        op.drop_table("media_info_partitioned")
+        return
+
+    # media_info is partitioned, move its rows back into a plain table
+    op.execute("LOCK TABLE media_info IN ACCESS EXCLUSIVE MODE")
+    op.execute("DROP TABLE IF EXISTS media_info_unpartitioned")
+    _create_media_info(
+        "media_info_unpartitioned", sa.String(length=255), partitioned=False
+    )
+    op.execute(
+        f"INSERT INTO media_info_unpartitioned (id, {COLUMNS}) "
+        f"SELECT id::text, {COLUMNS} FROM media_info"
+    )
+    op.drop_table("media_info")
+    op.rename_table("media_info_unpartitioned", "media_info")
+    op.execute("ALTER INDEX media_info_unpartitioned_pkey RENAME TO media_info_pkey")
+    op.execute(
+        "ALTER INDEX ix_media_info_unpartitioned_content_hash "
+        "RENAME TO ix_media_info_content_hash"
+    )
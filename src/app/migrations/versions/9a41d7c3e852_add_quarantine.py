@@ -0,0 +1,40 @@
+"""add content hash and quarantined files
+
+Revision ID: 9a41d7c3e852
+Revises: 5e0f1c2a7b3d
+Create Date: 2026-10-19 11:03:17.550412
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "9a41d7c3e852"
+down_revision = "5e0f1c2a7b3d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "media_info", sa.Column("content_hash", sa.String(length=64), nullable=True)
+    )
+    op.create_index(
+        op.f("ix_media_info_content_hash"), "media_info", ["content_hash"], unique=False
+    )
+    op.create_table(
+        "quarantined_file",
+        sa.Column("id", sa.String(length=64), nullable=False),
+        sa.Column("media_id", sa.String(length=255), nullable=True),
+        sa.Column("reason", sa.Text(), nullable=True),
+        sa.Column("failure_count", sa.Integer(), nullable=False),
+        sa.Column("quarantined", sa.Boolean(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade():
+    op.drop_table("quarantined_file")
+    op.drop_index(op.f("ix_media_info_content_hash"), table_name="media_info")
+    op.drop_column("media_info", "content_hash")
@@ -1,31 +1,63 @@
 """Models for the database"""
+import json
+import logging
+import os
 from contextlib import contextmanager
+from datetime import datetime
 from functools import wraps
 from io import BytesIO
-from typing import List, Optional
+from typing import Callable, List, Optional
 from uuid import uuid4
 
 from fastapi import HTTPException, status
 from pydantic import BaseModel, validator
-from sqlalchemy import Column, Enum, LargeBinary, String, Text
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    Enum,
+    Integer,
+    LargeBinary,
+    String,
+    Text,
+)
 from sqlalchemy import text as sqlalchemy_text
 from sqlalchemy.dialects.postgresql import ARRAY, UUID
 from sqlalchemy.ext.declarative import declared_attr
-from typeguard import typechecked
 
+from app import tracing
+from app.cache import response_cache
 from app.database import db_instance, get_db_session
 from app.models.mixin import GetOr404Mixin, UniqueSlugMixin
+from app.models.partitioning import UUIDKey, create_partitions_with
+from app.optimize import OptimizationReport
 from app.schema.media_info import CreateMediaInfo, EditMediaInfo
 from app.type import FileType
-from app.utils import convert_img_to_png_io, convert_pdf_to_png_io
+from app.utils import (
+    content_hash,
+    convert_img_to_png_io,
+    convert_pdf_to_png_io,
+    convert_to_preview_io,
+    typechecked,
+)
 
 Base = db_instance.base
 
+# failed attempts (including worker crashes) before a file is quarantined
+QUARANTINE_THRESHOLD = int(os.getenv("QUARANTINE_THRESHOLD", "3"))
+
 
 def string_uuid():
     return str(uuid4())
 
 
+class Blob(LargeBinary):
+    """bytea column handing back the driver's memoryview instead of a bytes copy."""
+
+    def result_processor(self, dialect, coltype):
+        return None
+
+
 @typechecked
 class BaseSQL(Base):
     __abstract__ = True
@@ -53,14 +85,38 @@ class BaseSQL(Base):
             session.rollback()
             raise e
 
+    @classmethod
+    def settled(cls, obj) -> bool:
+        """Whether a row is in a state later writes do not change, so that a
+        lagging replica returns it as the primary would."""
+        return False
+
+    @classmethod
+    def settled_clause(cls):
+        """settled() as a SQL condition, None when rows are never settled."""
+        return None
+
+    @classmethod
+    def _settled_query(cls, *criteria) -> Optional[Callable]:
+        """Query telling whether the rows matching criteria exist and are all
+        settled, without loading them."""
+        clause = cls.settled_clause()
+        if clause is None:
+            return None
+
+        def settled(session) -> bool:
+            rows = session.query(clause).filter(*criteria).all()
+            return bool(rows) and all(row[0] for row in rows)
+
+        return settled
+
     @classmethod
     def get(cls, id: str):
-        session = cls.session()
-        try:
-            return session.query(cls).filter(cls.id == id).first()
-        except Exception as e:
-            session.rollback()
-            raise e
+        return db_instance.run_read(
+            lambda session: session.query(cls).filter(cls.id == id).first(),
+            key=id,
+            settled=cls._settled_query(cls.id == id),
+        )
 
     @classmethod
     def edit(cls, id: str, **kwargs):
@@ -84,46 +140,191 @@ class BaseSQL(Base):
 
     @classmethod
     def filter(cls, **kwargs):
-        session = cls.session()
-        try:
-            return session.query(cls).filter_by(**kwargs).all()
-        except Exception as e:
-            session.rollback()
-            raise e
+        return db_instance.run_read(
+            lambda session: session.query(cls).filter_by(**kwargs).all(),
+            key=kwargs.get("id"),
+            settled=cls._settled_query(
+                *(getattr(cls, name) == value for name, value in kwargs.items())
+            ),
+        )
 
 
 class MediaInfo(BaseSQL, GetOr404Mixin, UniqueSlugMixin):
     __tablename__ = "media_info"
-    id = Column(String(255), primary_key=True)
+    __table_args__ = {"postgresql_partition_by": "HASH (id)"}
+    id = Column(UUIDKey, primary_key=True)
     file_name = Column(String, nullable=True)
-    raw_file = Column(LargeBinary, nullable=False)
+    raw_file = Column(Blob, nullable=False)
     file_type = Column(Enum(FileType), nullable=False)
-    processed_files = Column(ARRAY(LargeBinary), nullable=True)
+    processed_files = Column(ARRAY(Blob), nullable=True)
+    preview_files = Column(ARRAY(Blob), nullable=True)
+    content_hash = Column(String(64), nullable=True, index=True)
+    # indexes of near blank full resolution pages
+    blank_pages = Column(ARRAY(Integer), nullable=True)
 
     @classmethod
     def create(cls, create_media_info: CreateMediaInfo) -> "MediaInfo":
-        return super().create(**create_media_info.db_value, id=string_uuid())
+        db_value = create_media_info.db_value
+        db_value.setdefault("content_hash", content_hash(db_value["raw_file"]))
+        return super().create(**db_value, id=string_uuid())
 
     @classmethod
     def edit(cls, id: str, edit_media_info: EditMediaInfo) -> "MediaInfo":
         cls.get_or_404(id=id)
-        return super().edit(id, **edit_media_info.db_value)
+        result = super().edit(id, **edit_media_info.db_value)
+        response_cache.invalidate(id)
+        return result
 
     @classmethod
     def delete(cls, id):
-        return super().delete(id=id)
+        result = super().delete(id=id)
+        response_cache.invalidate(id)
+        return result
+
+    @classmethod
+    def settled(cls, obj) -> bool:
+        # rows only change until their full resolution pages are stored
+        return obj.processed_files is not None
+
+    @classmethod
+    def settled_clause(cls):
+        return cls.processed_files.isnot(None)
+
+    def process_preview(self):
+        with tracing.span("render.preview", file_type=self.file_type.value):
+            preview_files = convert_to_preview_io(self.raw_file, self.file_type)
+        edit_media_info = EditMediaInfo(preview_files=preview_files)
+        if not self.content_hash:
+            # rows stored before content hashes were recorded get theirs once here
+            edit_media_info.content_hash = content_hash(self.raw_file)
+        with tracing.span("db.edit", table="media_info", field="preview_files"):
+            self.edit(id=self.id, edit_media_info=edit_media_info)
 
     def process_file(self):
-        if self.file_type == FileType.PDF:
-            processed_files = convert_pdf_to_png_io(self.raw_file)
-        else:
-            processed_files = [convert_img_to_png_io(self.raw_file)]
-        self.edit(
-            id=self.id, edit_media_info=EditMediaInfo(processed_files=processed_files)
-        )
+        report = OptimizationReport()
+        with tracing.span("render.full", file_type=self.file_type.value) as span:
+            if self.file_type == FileType.PDF:
+                processed_files = convert_pdf_to_png_io(self.raw_file, report=report)
+            else:
+                processed_files = [convert_img_to_png_io(self.raw_file, report=report)]
+            span.set(stored_bytes=report.stored_bytes, saved_bytes=report.saved_bytes)
+        logging.info(f"stored pages of {self.id}: {report.summary()}")
+        with tracing.span("db.edit", table="media_info", field="processed_files"):
+            self.edit(
+                id=self.id,
+                edit_media_info=EditMediaInfo(
+                    processed_files=processed_files, blank_pages=report.blank_pages
+                ),
+            )
         return MediaInfo.session().query(MediaInfo).filter_by(id=self.id).first()
 
 
+create_partitions_with(MediaInfo.__table__)
+
+
+class QuarantinedFile(BaseSQL):
+    """Failure record of a file content, keyed by its sha256.
+
+    Once quarantined, uploads with the same content are rejected and queued
+    processing of it is dead-lettered instead of rendered again.
+    """
+
+    __tablename__ = "quarantined_file"
+    id = Column(String(64), primary_key=True)
+    media_id = Column(String(255), nullable=True)
+    reason = Column(Text, nullable=True)
+    failure_count = Column(Integer, nullable=False, default=0)
+    quarantined = Column(Boolean, nullable=False, default=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def settled(cls, obj) -> bool:
+        # quarantine is never lifted
+        return obj.quarantined
+
+    @classmethod
+    def settled_clause(cls):
+        return cls.quarantined
+
+    @classmethod
+    def is_quarantined(cls, content_hash: str) -> bool:
+        record = cls.get(content_hash)
+        return bool(record and record.quarantined)
+
+    @classmethod
+    def record_failure(
+        cls, content_hash: str, media_id: str, reason: str, deterministic: bool = False
+    ) -> bool:
+        """Count a failed attempt and return whether the content is now quarantined."""
+        session = cls.session()
+        try:
+            record = (
+                session.query(cls)
+                .filter(cls.id == content_hash)
+                .with_for_update()
+                .first()
+            )
+            if record is None:
+                record = cls(id=content_hash, failure_count=0, quarantined=False)
+                session.add(record)
+            record.media_id = media_id
+            record.reason = reason
+            record.failure_count += 1
+            record.quarantined = (
+                record.quarantined
+                or deterministic
+                or record.failure_count >= QUARANTINE_THRESHOLD
+            )
+            record.updated_at = datetime.utcnow()
+            session.commit()
+            return record.quarantined
+        except Exception as e:
+            session.rollback()
+            raise e
+
+
+class TaskOutbox(BaseSQL):
+    """Task messages waiting for the broker to come back."""
+
+    __tablename__ = "task_outbox"
+    id = Column(String(255), primary_key=True)
+    task_name = Column(String(255), nullable=False)
+    args = Column(Text, nullable=False)
+    headers = Column(Text, nullable=False)
+    options = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    @classmethod
+    def store(cls, messages: list):
+        session = cls.session()
+        try:
+            for message in messages:
+                session.add(
+                    cls(
+                        id=string_uuid(),
+                        task_name=message.name,
+                        args=json.dumps(message.args),
+                        headers=json.dumps(message.headers),
+                        options=json.dumps(message.options),
+                    )
+                )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def claim(cls, session, limit: int) -> list:
+        """Lock the oldest messages, skipping those another process is relaying."""
+        return (
+            session.query(cls)
+            .order_by(cls.created_at)
+            .with_for_update(skip_locked=True)
+            .limit(limit)
+            .all()
+        )
+
+
 if __name__ == "__main__":
     from app.database import db_instance
 
@@ -1,5 +1,6 @@
 from fastapi import HTTPException, status
-from typeguard import typechecked
+
+from app.utils import typechecked
 
 
 @typechecked
@@ -0,0 +1,64 @@
+"""Hash partitioning of media_info by id.
+
+media_info is declared `PARTITION BY HASH (id)` on a native UUID key. Postgres
+prunes lookups by id to a single partition. Partitions are created with the
+table (after_create for create_all, the Alembic migration for existing
+databases), and existing deployments move their rows over online with
+`python -m app.scripts.partition_media_info`.
+"""
+from typing import List
+
+from sqlalchemy import event
+from sqlalchemy.types import UserDefinedType
+
+# matches the 7d3e5a9c1b20 migration, changing it means partitioning again
+PARTITION_COUNT = 16
+
+
+class UUIDKey(UserDefinedType):
+    """Native UUID column exchanged as str.
+
+    Values are bound as plain string literals, so the same queries work against
+    the legacy varchar table and the partitioned UUID table, and Postgres can
+    still prune partitions at plan time.
+    """
+
+    cache_ok = True
+
+    def get_col_spec(self, **kw):
+        return "UUID"
+
+    def bind_processor(self, dialect):
+        def process(value):
+            return None if value is None else str(value)
+
+        return process
+
+    def literal_processor(self, dialect):
+        def process(value):
+            return "'%s'" % str(value).replace("'", "''")
+
+        return process
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            return None if value is None else str(value)
+
+        return process
+
+
+def hash_partitions_ddl(table: str, count: int = PARTITION_COUNT) -> List[str]:
+    return [
+        f"CREATE TABLE IF NOT EXISTS {table}_p{remainder} PARTITION OF {table} "
+        f"FOR VALUES WITH (MODULUS {count}, REMAINDER {remainder})"
+        for remainder in range(count)
+    ]
+
+
+def create_partitions_with(table, count: int = PARTITION_COUNT):
+    """Create the hash partitions whenever metadata.create_all creates table."""
+
+    @event.listens_for(table, "after_create")
+    def _create_partitions(target, connection, **kw):
+        for statement in hash_partitions_ddl(target.name, count):
+            connection.exec_driver_sql(statement)
@@ -0,0 +1,206 @@
+"""Size optimization of rendered pages.
+
+Most pages are scanned black and white text, stored as full RGB PNGs they are
+several times larger than they need to be. Before a page is encoded its pixels
+are analysed with NumPy: grayscale pages are stored as 8-bit and bilevel pages
+as 1-bit PNGs, pages with only a few colours are quantized to a palette, and
+near blank pages are flagged so they can be skipped.
+"""
+import os
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+from app.type import Buffer
+
+PAGE_OPTIMIZE = os.getenv("PAGE_OPTIMIZE", "true").lower() in ("1", "true", "yes")
+# zlib level, lower is faster and larger
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "6"))
+# largest channel spread still treated as gray
+GRAY_TOLERANCE = int(os.getenv("PAGE_GRAY_TOLERANCE", "8"))
+# share of mid-tone pixels (anti-aliasing, scan noise) a bilevel page may have
+BILEVEL_MAX_MIDTONES = float(os.getenv("PAGE_BILEVEL_MAX_MIDTONES", "0.02"))
+PALETTE_MAX_COLORS = int(os.getenv("PAGE_PALETTE_MAX_COLORS", "16"))
+# share of pixels the palette colours must cover, the rest (mostly anti-aliased
+# edges) is mapped to the nearest palette colour
+PALETTE_MIN_COVERAGE = float(os.getenv("PAGE_PALETTE_MIN_COVERAGE", "0.98"))
+# share of pixels differing from the background below which a page is blank
+BLANK_PAGE_INK_RATIO = float(os.getenv("BLANK_PAGE_INK_RATIO", "0.0005"))
+# "keep" stores blank pages like any other, "skip" stores an empty page
+BLANK_PAGES = os.getenv("BLANK_PAGES", "keep")
+# also encode pages unoptimized to report the exact bytes saved
+OPTIMIZE_MEASURE = os.getenv("OPTIMIZE_MEASURE", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+ANALYZED_MODES = ("1", "L", "P", "RGB")
+BILEVEL_MARGIN = 64
+INK_CONTRAST = 48
+SAMPLE_STEP = 4
+
+
+@dataclass
+class OptimizationReport:
+    """Per document record of how pages were stored.
+
+    baseline_bytes is only known when pages are also encoded the way they were
+    stored before optimization (measure), which doubles the encoding cost.
+    """
+
+    measure: bool = OPTIMIZE_MEASURE
+    modes: List[str] = field(default_factory=list)
+    blank_pages: List[int] = field(default_factory=list)
+    stored_bytes: int = 0
+    baseline_bytes: Optional[int] = None
+
+    def add(self, mode: str, blank: bool, stored: int, baseline: Optional[int]):
+        if blank:
+            self.blank_pages.append(len(self.modes))
+        self.modes.append(mode)
+        self.stored_bytes += stored
+        if baseline is not None:
+            self.baseline_bytes = (self.baseline_bytes or 0) + baseline
+
+    @property
+    def saved_bytes(self) -> Optional[int]:
+        if self.baseline_bytes is None:
+            return None
+        return self.baseline_bytes - self.stored_bytes
+
+    def summary(self) -> str:
+        counts = ", ".join(
+            f"{self.modes.count(mode)} {mode}" for mode in sorted(set(self.modes))
+        )
+        summary = (
+            f"{len(self.modes)} pages ({counts}), {len(self.blank_pages)} blank, "
+            f"{self.stored_bytes} bytes stored"
+        )
+        if self.saved_bytes is not None:
+            ratio = self.baseline_bytes / max(self.stored_bytes, 1)
+            summary += f", {self.saved_bytes} bytes saved ({ratio:.1f}x smaller)"
+        return summary
+
+
+def analyze(image) -> Tuple[str, bool]:
+    """Return the narrowest lossless-enough mode for image and whether it is blank.
+
+    Modes are "bilevel", "grayscale", "palette" and "color". Only 1, L, P and
+    RGB images are analysed, anything else is "color" and stored unchanged:
+    flattening an alpha channel would change the page, and 16-bit, 32-bit and
+    float images would lose their depth.
+    """
+    import numpy as np
+
+    if image.mode not in ANALYZED_MODES or "transparency" in image.info:
+        return "color", False
+
+    # blank and bilevel pages are told apart by the luminance histogram alone
+    histogram = np.bincount(np.asarray(image.convert("L")).ravel(), minlength=256)
+    blank = _is_blank(histogram)
+    if image.mode not in ("1", "L") and not _is_gray(np.asarray(image.convert("RGB"))):
+        return ("palette" if _few_colors(image) else "color"), blank
+    midtones = histogram[BILEVEL_MARGIN + 1 : 255 - BILEVEL_MARGIN].sum()
+    if image.mode == "1" or midtones <= BILEVEL_MAX_MIDTONES * histogram.sum():
+        return "bilevel", blank
+    return "grayscale", blank
+
+
+def _is_blank(histogram) -> bool:
+    import numpy as np
+
+    # the most common level is the paper, which need not be pure white in a scan
+    background = histogram.argmax()
+    ink = histogram[np.abs(np.arange(256) - background) > INK_CONTRAST].sum()
+    return bool(ink <= BLANK_PAGE_INK_RATIO * histogram.sum())
+
+
+def _is_gray(pixels) -> bool:
+    import numpy as np
+
+    red, green, blue = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    spread = np.maximum(np.maximum(red, green), blue) - np.minimum(
+        np.minimum(red, green), blue
+    )
+    return bool(spread.max() <= GRAY_TOLERANCE)
+
+
+def _few_colors(image) -> bool:
+    import numpy as np
+
+    # colours are counted on a sample, quantizing settles the exact palette
+    sample = np.asarray(image.convert("RGB"))[::SAMPLE_STEP, ::SAMPLE_STEP]
+    sample = sample.reshape(-1, 3).astype(np.uint32)
+    packed = (sample[:, 0] << 16) | (sample[:, 1] << 8) | sample[:, 2]
+    _, counts = np.unique(packed, return_counts=True)
+    if len(counts) <= PALETTE_MAX_COLORS:
+        return True
+    top = np.partition(counts, -PALETTE_MAX_COLORS)[-PALETTE_MAX_COLORS:]
+    return bool(top.sum() >= PALETTE_MIN_COVERAGE * packed.size)
+
+
+def optimize_image(image):
+    """Return image converted to its narrowest mode, that mode and whether it is blank."""
+    from PIL import Image
+
+    mode, blank = analyze(image)
+    if mode == "bilevel" and image.mode != "1":
+        image = image.convert("L").point(lambda v: 255 if v > 127 else 0, mode="1")
+    elif mode == "grayscale":
+        image = image.convert("L")
+    elif mode == "palette":
+        image = image.convert("RGB").quantize(
+            colors=PALETTE_MAX_COLORS,
+            method=Image.Quantize.FASTOCTREE,
+            dither=Image.Dither.NONE,
+        )
+    return image, mode, blank
+
+
+def encode_page(
+    image, format: str = "PNG", report: Optional[OptimizationReport] = None
+) -> memoryview:
+    """Encode a rendered page, optimized when stored as PNG."""
+    if not PAGE_OPTIMIZE or format.upper() != "PNG":
+        return _encode(image, format)
+
+    baseline = len(_encode(image, "PNG")) if report and report.measure else None
+    optimized, mode, blank = optimize_image(image)
+    if blank and BLANK_PAGES == "skip":
+        output = memoryview(b"")
+    else:
+        output = _encode(optimized, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    if report is not None:
+        report.add(mode, blank, len(output), baseline)
+    return output
+
+
+def optimize_encoded(
+    image, buffer: Buffer, report: Optional[OptimizationReport] = None
+) -> Buffer:
+    """Re-encode an opened image when that makes it smaller than its upload.
+
+    Uploads small enough are stored as they are, they are only replaced by the
+    optimized PNG when it beats the original.
+    """
+    if not PAGE_OPTIMIZE:
+        return buffer
+    optimized, mode, blank = optimize_image(image)
+    if blank and BLANK_PAGES == "skip":
+        output = memoryview(b"")
+    elif mode == "color":
+        output = buffer
+    else:
+        output = _encode(optimized, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+        if len(output) >= len(buffer):
+            output = buffer
+    if report is not None:
+        report.add(mode, blank, len(output), len(buffer))
+    return output
+
+
+def _encode(image, format: str, **params) -> memoryview:
+    output = BytesIO()
+    image.save(output, format=format, **params)
+    return output.getbuffer()
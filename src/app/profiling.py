@@ -0,0 +1,257 @@
+"""On-demand profiling of web and worker processes.
+
+Three ways to see where the CPU goes, none of which costs anything unless
+configured:
+
+- per request: with PROFILING_TOKEN set, a request carrying the token in the
+  X-Profile header runs under cProfile. The stats are written to PROFILE_DIR
+  (path in the X-Profile-Path response header) and merged into per-route
+  aggregates served by GET /debug/profile.
+- per task: Celery tasks named in PROFILE_TASKS run under cProfile and are
+  written to PROFILE_DIR and aggregated the same way.
+- whole process: POST /debug/profile/sample?seconds=N (web), or SIGUSR2 with
+  PROFILE_SIGNAL enabled (web and worker processes), samples every thread's
+  stack for a bounded time and writes collapsed stacks, the input format of
+  flamegraph.pl and speedscope.
+
+cProfile only sees the thread it is enabled on. For async routes that is the
+event loop, which also runs other requests meanwhile; work sent to the
+threadpool is only visible to the sampler.
+"""
+
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/scratch/profiles")
+# task names, with or without their module, e.g. "process_raw_file"
+PROFILE_TASKS = {
+    name.strip().rsplit(".", 1)[-1]
+    for name in os.getenv("PROFILE_TASKS", "").split(",")
+    if name.strip()
+}
+PROFILE_SIGNAL = os.getenv("PROFILE_SIGNAL", "false").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_SECONDS = float(os.getenv("PROFILE_SAMPLE_SECONDS", "30"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5")) / 1000
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "300"))
+
+PROFILE_HEADER = "x-profile"
+
+_aggregates: Dict[str, pstats.Stats] = {}
+_aggregates_lock = threading.Lock()
+# cProfile allows one active profiler per thread, and concurrent request
+# profiles would see each other's work, so requests are profiled one at a time
+_request_lock = threading.Lock()
+_sampler: Optional["Sampler"] = None
+_sampler_lock = threading.Lock()
+
+
+def authorized(token: Optional[str]) -> bool:
+    return bool(PROFILING_TOKEN and token) and hmac.compare_digest(
+        token.encode(), PROFILING_TOKEN.encode()
+    )
+
+
+def _output_path(kind: str, name: str, suffix: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in name).strip("_")
+    return os.path.join(
+        PROFILE_DIR, f"{kind}-{safe_name}-{os.getpid()}-{time.time_ns()}{suffix}"
+    )
+
+
+def _record(profile: cProfile.Profile, name: str, path: str):
+    profile.dump_stats(path)
+    with _aggregates_lock:
+        if name in _aggregates:
+            _aggregates[name].add(profile)
+        else:
+            _aggregates[name] = pstats.Stats(profile)
+
+
+@contextmanager
+def profiled(kind: str, name: str):
+    """Run the block under cProfile, then write and aggregate its stats."""
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _record(profile, name, _output_path(kind, name, ".pstats"))
+
+
+def task_profile(name: str):
+    """Profile a task run when its name is listed in PROFILE_TASKS."""
+    short_name = name.rsplit(".", 1)[-1]
+    if short_name not in PROFILE_TASKS:
+        return nullcontext()
+    return profiled("task", short_name)
+
+
+def aggregated_stats(limit: int = 30, sort: str = "cumulative") -> Dict[str, str]:
+    """Text summaries of the stats aggregated per route or task in this process."""
+    summaries = {}
+    with _aggregates_lock:
+        for name, stats in _aggregates.items():
+            output = io.StringIO()
+            stats.stream = output
+            stats.sort_stats(sort).print_stats(limit)
+            summaries[name] = output.getvalue()
+    return summaries
+
+
+class Sampler(threading.Thread):
+    """Samples the stacks of all other threads into collapsed stack counts."""
+
+    def __init__(self, seconds: float, interval: float, path: str):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.seconds = min(seconds, PROFILE_MAX_SECONDS)
+        self.interval = interval
+        self.path = path
+        self.stacks = Counter()
+
+    def run(self):
+        thread_names = {}
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                if thread_id not in thread_names:
+                    thread_names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                        f":{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+        with open(self.path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logging.info(f"wrote {sum(self.stacks.values())} stack samples to {self.path}")
+
+
+def start_sampling(
+    seconds: float = PROFILE_SAMPLE_SECONDS, interval: float = PROFILE_SAMPLE_INTERVAL
+) -> str:
+    """Start sampling the whole process, return the collapsed stacks path.
+
+    While a sampling run is in progress its path is returned instead.
+    """
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None or not _sampler.is_alive():
+            _sampler = Sampler(
+                seconds, interval, _output_path("sample", "process", ".collapsed")
+            )
+            _sampler.start()
+        return _sampler.path
+
+
+def install_signal_handler(**kwargs):
+    """Sample the process for PROFILE_SAMPLE_SECONDS on SIGUSR2, if enabled."""
+    if PROFILE_SIGNAL:
+        signal.signal(signal.SIGUSR2, lambda signum, frame: start_sampling())
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling requests that carry the profiling token."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = next(
+            (
+                value.decode("latin-1")
+                for key, value in scope["headers"]
+                if key == PROFILE_HEADER.encode()
+            ),
+            None,
+        )
+        if token is None or not authorized(token):
+            return await self.app(scope, receive, send)
+        if not _request_lock.acquire(blocking=False):
+            # another profiled request is running, serve this one normally
+            return await self.app(scope, receive, send)
+
+        path = _output_path("request", scope["path"], ".pstats")
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-path", path.encode())
+                ]
+            await send(message)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                await self.app(scope, receive, _send)
+            finally:
+                profile.disable()
+                # aggregated per route, the endpoint is known once routed
+                endpoint = scope.get("endpoint")
+                name = getattr(endpoint, "__name__", scope["path"])
+                _record(profile, f"{scope['method']} {name}", path)
+        finally:
+            _request_lock.release()
+
+
+def install(app):
+    """Wire the profiling hooks into the FastAPI app, as configured."""
+    install_signal_handler()
+    if not PROFILING_TOKEN:
+        return
+    from fastapi import APIRouter, Header, HTTPException, status
+
+    router = APIRouter(prefix="/debug/profile", tags=["PROFILING"])
+
+    def _check(token: Optional[str]):
+        if not authorized(token):
+            raise HTTPException(
+                detail="Not found", status_code=status.HTTP_404_NOT_FOUND
+            )
+
+    @router.get("")
+    async def get_profiles(
+        limit: int = 30, sort: str = "cumulative", x_profile: str = Header(None)
+    ):
+        """Per-route and per-task cProfile aggregates of this process."""
+        _check(x_profile)
+        return aggregated_stats(limit, sort)
+
+    @router.post("/sample")
+    async def sample_process(
+        seconds: float = PROFILE_SAMPLE_SECONDS, x_profile: str = Header(None)
+    ):
+        """Sample this process' stacks for a while, into a collapsed stacks file."""
+        _check(x_profile)
+        return {
+            "path": start_sampling(seconds),
+            "seconds": min(seconds, PROFILE_MAX_SECONDS),
+        }
+
+    app.add_middleware(ProfilingMiddleware)
+    app.include_router(router)
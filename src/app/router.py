@@ -6,14 +6,26 @@ from copy import deepcopy
 from io import BytesIO
 from typing import Any, Callable, Dict, List, Literal, Optional, Union
 
-import PyPDF2
-from fastapi import APIRouter, Body, Depends, File, HTTPException, UploadFile, status
-from pdf2image import convert_from_bytes
-from PIL import Image
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    File,
+    Header,
+    HTTPException,
+    Request,
+    Response,
+    UploadFile,
+    status,
+)
 from pydantic import BaseModel, root_validator
+from starlette.concurrency import run_in_threadpool
 
+from app import tracing
+from app.cache import response_cache
 from app.database import db_instance, get_db_session
-from app.models.main import MediaInfo
+from app.exceptions import BadRequest
+from app.models.main import MediaInfo, QuarantinedFile
 from app.schema.media_info import (
     CreateMediaInfo,
     MediaInfoResponse,
@@ -21,7 +33,9 @@ from app.schema.media_info import (
     PartialMediaInfoResponse,
 )
 from app.type import FileType
-from app.utils import convert_img_to_png_io, convert_pdf_to_png_io, db_session_wrapper
+from app.uploads import MAX_UPLOAD_LENGTH, UploadSession
+from app.utils import content_hash, db_session_wrapper
+from app.workers.backend import task_backend
 from app.workers.tasks import process_raw_file
 
 router = APIRouter(tags=["CONVERTER"])
@@ -46,19 +60,167 @@ async def upload_files(file_type: FileType, file: UploadFile):
 
     Raises:
         HTTPError: If an error occurs during processing
+        ServiceUnavailable: If the processing backlog is over its limits.
+        TooManyRequests: If the client exceeds its concurrency or byte-rate limits.
     """
-    media_infos = [
-        MediaInfo.create(
-            CreateMediaInfo(
+    with tracing.span("http.upload", file_type=file_type.value):
+        with tracing.span("upload.read_body") as span:
+            file.file.seek(0, os.SEEK_END)
+            if file.file.tell() > MAX_UPLOAD_LENGTH:
+                raise BadRequest(f"Files are limited to {MAX_UPLOAD_LENGTH} bytes")
+            file.file.seek(0)
+            # the bytes object is the only copy of the upload, everything
+            # downstream shares it
+            raw_file = file.file.read()
+            span.set(bytes=len(raw_file))
+        file_hash = reject_quarantined(raw_file)
+        with tracing.span("upload.validate_file"):
+            create_media_info = CreateMediaInfo(
                 file_type=file_type,
-                raw_file=BytesIO(file.file.read()),
+                raw_file=raw_file,
                 file_name=file.filename,
+                content_hash=file_hash,
+            )
+        return [await create_and_process(create_media_info)]
+
+
+def reject_quarantined(raw_file: bytes) -> str:
+    """Return the file's content hash, refusing content known to break processing."""
+    with tracing.span("upload.quarantine_check"):
+        file_hash = content_hash(raw_file)
+        if QuarantinedFile.is_quarantined(file_hash):
+            raise BadRequest(
+                "File was quarantined after failing processing and will not be accepted"
+            )
+    return file_hash
+
+
+async def create_and_process(create_media_info: CreateMediaInfo) -> MediaInfo:
+    with tracing.span("db.insert", table="media_info"):
+        media_info = await run_in_threadpool(MediaInfo.create, create_media_info)
+    with tracing.span("task.submit", task="process_raw_file"):
+        try:
+            await task_backend.submit(
+                process_raw_file.name, args=[media_info.id], headers=tracing.inject()
             )
-        )
-    ]
-    for media_info in media_infos:
-        process_raw_file.apply_async(args=[media_info.id])
-    return media_infos
+        except Exception:
+            # nothing would ever process it
+            await run_in_threadpool(MediaInfo.delete, media_info.id)
+            raise
+    return media_info
+
+
+def _upload_offset_headers(upload: UploadSession, offset: int) -> Dict[str, str]:
+    return {
+        "Upload-Offset": str(offset),
+        "Upload-Length": str(upload.length),
+        "Cache-Control": "no-store",
+    }
+
+
+@router.post("/uploads", status_code=status.HTTP_201_CREATED)
+async def create_upload_session(
+    file_type: FileType,
+    file_name: str,
+    response: Response,
+    upload_length: int = Header(...),
+):
+    """
+    Start a resumable upload.
+
+    Args:
+        file_type (FileType): The type of the uploaded file.
+        file_name (str): Name of the uploaded file.
+        upload_length (int): Total size of the file in bytes (Upload-Length header).
+
+    Returns:
+        Dict: The upload id and its current offset. The Location header points to
+        the session, chunks are sent to it with PATCH.
+    """
+    upload = await run_in_threadpool(
+        UploadSession.create, file_type, file_name, upload_length
+    )
+    response.headers.update(_upload_offset_headers(upload, 0))
+    response.headers["Location"] = f"/uploads/{upload.id}"
+    return {"id": upload.id, "offset": 0, "length": upload.length}
+
+
+@router.head("/uploads/{upload_id}", status_code=status.HTTP_200_OK)
+async def get_upload_offset(upload_id: str):
+    """Report how many contiguous bytes of the upload were received."""
+    upload = UploadSession.get_or_404(upload_id)
+    offset = await run_in_threadpool(lambda: upload.offset)
+    return Response(headers=_upload_offset_headers(upload, offset))
+
+
+@router.patch("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def upload_chunk(
+    upload_id: str, request: Request, upload_offset: int = Header(...)
+):
+    """
+    Append a chunk to a resumable upload.
+
+    The request body is streamed to disk. Chunks for different offsets may be
+    sent in parallel; the returned Upload-Offset header is the contiguous length
+    received so far.
+    """
+    upload = UploadSession.get_or_404(upload_id)
+    offset = await upload.write_chunk(upload_offset, request.stream())
+    return Response(
+        status_code=status.HTTP_204_NO_CONTENT,
+        headers=_upload_offset_headers(upload, offset),
+    )
+
+
+@router.delete("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def abort_upload(upload_id: str):
+    """Discard a resumable upload and its staged chunks."""
+    await run_in_threadpool(UploadSession.get_or_404(upload_id).discard)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.post(
+    "/uploads/{upload_id}/finalize",
+    status_code=status.HTTP_201_CREATED,
+    response_model=List[MediaInfoResponse],
+)
+async def finalize_upload(upload_id: str):
+    """
+    Complete a resumable upload and hand it over to processing.
+
+    Returns:
+        List[MediaInfoResponse]: List of created media information.
+
+    Raises:
+        BadRequest: If chunks are still missing.
+        HTTPException: 409 if the upload is already being finalized.
+    """
+
+    def _assemble(upload: UploadSession) -> CreateMediaInfo:
+        with tracing.span("upload.assemble", bytes=upload.length):
+            with open(upload.assemble(), "rb") as f:
+                raw_file = f.read()
+        file_hash = reject_quarantined(raw_file)
+        with tracing.span("upload.validate_file"):
+            return CreateMediaInfo(
+                file_type=upload.file_type,
+                raw_file=raw_file,
+                file_name=upload.file_name,
+                content_hash=file_hash,
+            )
+
+    with tracing.span("http.finalize_upload", upload_id=upload_id):
+        upload = UploadSession.get_or_404(upload_id)
+        # concurrent finalize calls would each create a row for the upload
+        upload.claim()
+        try:
+            create_media_info = await run_in_threadpool(_assemble, upload)
+            media_info = await create_and_process(create_media_info)
+        except BaseException:
+            upload.release()
+            raise
+        await run_in_threadpool(upload.discard)
+        return [media_info]
 
 
 @db_session_wrapper
@@ -68,7 +230,10 @@ async def upload_files(file_type: FileType, file: UploadFile):
     response_model=Union[PartialMediaInfoResponse, MessageResponse],
 )
 async def fetch_processed_file(
-    source: Literal["raw", "processed", "all"], media_id: str, idx: str = "-1"
+    source: Literal["raw", "processed", "all"],
+    media_id: str,
+    idx: str = "-1",
+    quality: Literal["auto", "preview", "full"] = "auto",
 ):
     """
     Fetch processed file information.
@@ -77,20 +242,50 @@ async def fetch_processed_file(
         source (Literal["raw", "processed", "all"]): Type of file information to retrieve.
         media_id (str): The ID of the media information.
         idx (str, optional): Index of the processed file to retrieve(used for pdf, idx is index of the page). Defaults to "-1".
+        quality (Literal["auto", "preview", "full"], optional): Page quality to return. "auto" returns the
+            full resolution pages when rendered and the previews otherwise. Defaults to "auto".
 
     Returns:
-        Union[PartialMediaInfoResponse, MessageResponse]: Partial or complete media information.
+        Union[PartialMediaInfoResponse, MessageResponse]: Partial or complete media information,
+            `quality` tells which pages were returned.
 
     Raises:
         HTTPError: If an error occurs during processing
         MessageResponse:   if the file has not been processed.
     """
-    idx = list(map(int, idx.split(",")))
-    media_info = MediaInfo.get_or_404(id=media_id)
-    # if not media_info.processed_files:
-    #     return MessageResponse(
-    #         detail="File has not been processed yet. Please try again later.",
-    #     )
-    return PartialMediaInfoResponse.response_value(
-        obj=media_info, source=source, idx=idx
-    )
+    with tracing.span("http.download", media_id=media_id, source=source) as span:
+        try:
+            # media_info is keyed by a native uuid, a malformed id can never match
+            uuid.UUID(media_id)
+        except ValueError:
+            raise HTTPException(
+                detail=f"MediaInfo with {{'id': '{media_id}'}} not found",
+                status_code=status.HTTP_404_NOT_FOUND,
+            )
+        idx = list(map(int, idx.split(",")))
+        cache_source = f"{source}:{quality}"
+        if (cached := response_cache.get(media_id, cache_source, idx)) is not None:
+            span.set(cache_hit=True)
+            return cached
+        with tracing.span("db.get", table="media_info"):
+            media_info = MediaInfo.get_or_404(id=media_id)
+        # if not media_info.processed_files:
+        #     return MessageResponse(
+        #         detail="File has not been processed yet. Please try again later.",
+        #     )
+        with tracing.span("download.encode"):
+            response = PartialMediaInfoResponse.response_value(
+                obj=media_info, source=source, idx=idx, quality=quality
+            )
+        # only cache once the requested pages are final, the worker fills them in
+        # another process; raw responses carry the page count too
+        final_quality = "preview" if quality == "preview" else "full"
+        if media_info.content_hash and (
+            MediaInfo.settled(media_info)
+            if source == "raw"
+            else response.get("quality") == final_quality
+        ):
+            response_cache.set(
+                media_id, media_info.content_hash, cache_source, idx, response
+            )
+        return response
@@ -1,54 +1,49 @@
 import base64
 import contextlib
-from copy import deepcopy
-from io import BytesIO
 from typing import Any, Dict, List, Literal, Optional, Union
 
-from pdf2image import convert_from_bytes
-from PIL import Image
 from pydantic import BaseModel, Field, root_validator, validator
 
 from app.database import db_instance
 from app.exceptions import BadRequest
-from app.type import FileType
+from app.type import Buffer, FileType
 
 
 class BaseMediaInfo(BaseModel):
     @property
     def db_value(self) -> Dict:
-        obj = self.dict(exclude_unset=True, exclude_none=True)
-        if raw_file := obj.get("raw_file"):
-            obj["raw_file"] = raw_file.getvalue()
-        if processed_files := obj.get("processed_files"):
-            obj["processed_files"] = [
-                processed_file.getvalue() for processed_file in processed_files
-            ]
-        return obj
+        # buffers are handed to the database driver as they are, without copies
+        return self.dict(exclude_unset=True, exclude_none=True)
 
 
 class CreateMediaInfo(BaseMediaInfo):
-    raw_file: BytesIO
+    raw_file: Buffer
     file_type: FileType
     file_name: str
-    processed_files: Optional[List[BytesIO]]
-
-    class Config:
-        arbitrary_types_allowed = True
+    processed_files: Optional[List[Buffer]]
+    content_hash: Optional[str]
 
     @root_validator
     def validate_file(cls, values):
         def _get_file_type(file_bytes):
-            file_bytes_copy = deepcopy(file_bytes)
-            try:
-                convert_from_bytes(file_bytes_copy.getvalue())
-                return FileType.PDF
-            except Exception:
-                ...
+            from pdf2image import pdfinfo_from_bytes
+            from PIL import Image
+
+            from app.utils import buffer_reader
+
+            # parsing the document is enough to tell a valid PDF, rendering it
+            # here would allocate every page at upload time
+            if b"%PDF" in bytes(file_bytes[:1024]):
+                try:
+                    pdfinfo_from_bytes(file_bytes)
+                    return FileType.PDF
+                except Exception:
+                    ...
 
             supported_img_formats = {
-                FileType.PNG: lambda: Image.open(file_bytes).verify(),
-                FileType.JPG: lambda: Image.open(file_bytes).verify(),
-                FileType.JPEG: lambda: Image.open(file_bytes).verify(),
+                FileType.PNG: lambda: Image.open(buffer_reader(file_bytes)).verify(),
+                FileType.JPG: lambda: Image.open(buffer_reader(file_bytes)).verify(),
+                FileType.JPEG: lambda: Image.open(buffer_reader(file_bytes)).verify(),
             }
             for format, conversion_function in supported_img_formats.items():
                 with contextlib.suppress(IOError, SyntaxError):
@@ -68,10 +63,10 @@ class CreateMediaInfo(BaseMediaInfo):
 
 class EditMediaInfo(BaseMediaInfo):
     file_name: Optional[str]
-    processed_files: Optional[List[BytesIO]]
-
-    class Config:
-        arbitrary_types_allowed = True
+    processed_files: Optional[List[Buffer]]
+    preview_files: Optional[List[Buffer]]
+    blank_pages: Optional[List[int]]
+    content_hash: Optional[str]
 
 
 class MediaInfoResponse(BaseModel, orm_mode=True):
@@ -86,41 +81,53 @@ class PartialMediaInfoResponse(MediaInfoResponse, orm_mode=True):
     processed_files: Optional[List[bytes]]
     processed_total_count: Optional[int] = 1
     processed_count: Optional[int] = 0
+    content_hash: Optional[str]
+    quality: Optional[Literal["preview", "full"]]
+    blank_pages: Optional[List[int]]
 
     @classmethod
     def response_value(
-        cls, obj, source: Literal["all", "processed", "raw"], idx: List[int] = None
+        cls,
+        obj,
+        source: Literal["all", "processed", "raw"],
+        idx: List[int] = None,
+        quality: Literal["auto", "preview", "full"] = "auto",
     ) -> Dict:
         def _decode_raw_bytes(value):
-            if isinstance(value, bytes):
-                return base64.b64encode(obj.raw_file).decode("utf-8")
-            return [base64.b64encode(file).decode("utf-8") for file in value]
+            # base64 stays bytes, it is decoded once when the response is encoded
+            if not isinstance(value, list):
+                return base64.b64encode(value)
+            return [base64.b64encode(file) for file in value]
 
         idx = idx or [-1]
-        processed_file_count = len(obj.processed_files) if obj.processed_files else 0
+        # serve previews while the full resolution pages are still rendering
+        pages, served_quality = obj.processed_files, "full"
+        if quality == "preview" or (quality == "auto" and not obj.processed_files):
+            pages, served_quality = obj.preview_files, "preview"
+        processed_file_count = len(pages) if pages else 0
         response = {
             "id": obj.id,
             "idx": idx,
             "file_name": obj.file_name,
             "file_type": obj.file_type,
             "processed_total_count": processed_file_count,
+            "content_hash": obj.content_hash,
         }
         if source in ["all", "raw"] and obj.raw_file:
             response["raw_file"] = _decode_raw_bytes(obj.raw_file)
-        if source in ["all", "processed"] and obj.processed_files:
+        if source in ["all", "processed"] and pages:
             if any(i >= processed_file_count or i < -1 for i in idx):
                 raise BadRequest("Invalid indexes selected")
-            processed_files = (
-                [obj.processed_files[i] for i in idx]
-                if idx[0] != -1
-                else obj.processed_files
-            )
+            processed_files = [pages[i] for i in idx] if idx[0] != -1 else pages
             response.update(
                 {
                     "processed_files": _decode_raw_bytes(processed_files),
                     "processed_count": len(processed_files),
+                    "quality": served_quality,
                 }
             )
+            if served_quality == "full" and getattr(obj, "blank_pages", None):
+                response["blank_pages"] = obj.blank_pages
         return response
 
 
@@ -0,0 +1,363 @@
+"""Bulk import of a directory tree or manifest of documents.
+
+Usage:
+    python -m app.scripts.bulk_ingest /archive [--manifest files.txt]
+        [--workers 4] [--batch-size 50] [--process publish|inline|none]
+        [--render-processes 4] [--checkpoint /scratch/bulk_ingest.journal]
+
+Files are typed by their magic bytes instead of the full upload validation,
+and inserted into media_info in multi-row INSERTs by a pool of writer threads,
+each batch in its own transaction. Processing is then queued with one grouped
+publish per batch (`publish`, falling back to the task outbox like uploads),
+rendered by a local process pool (`inline`, the default with TASK_BACKEND=local),
+or left for later (`none`).
+
+Every imported file is appended to a journal, an interrupted import run again
+with the same checkpoint skips what was already imported. A batch interrupted
+between its commit and its journal entry is imported again. Rows whose inline
+render was interrupted or failed keep no processed_files, their ids are logged.
+Failed batches are logged and not journaled, so that running the import again
+retries them; the run then exits with status 1.
+"""
+import argparse
+import csv
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass
+from multiprocessing import get_context
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from sqlalchemy import insert, select
+
+from app.database import db_instance
+from app.models.main import MediaInfo, QuarantinedFile, string_uuid
+from app.type import FileType
+from app.utils import content_hash
+from app.workers.backend import TASK_BACKEND
+
+DEFAULT_CHECKPOINT = "/scratch/bulk_ingest.journal"
+MAGIC_BYTES = [
+    (b"%PDF", FileType.PDF),
+    (b"\x89PNG\r\n\x1a\n", FileType.PNG),
+    (b"\xff\xd8\xff", FileType.JPEG),
+]
+SNIFF_LENGTH = 8
+
+
+@dataclass
+class IngestFile:
+    path: str
+    file_name: str
+    file_type: FileType
+    size: int
+
+
+class Progress:
+    """Thread safe counters with a periodic throughput line."""
+
+    def __init__(self, interval: float = 10):
+        self.interval = interval
+        self.started_at = self.logged_at = time.monotonic()
+        self.files = self.bytes = self.skipped = self.rendered = self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        files: int = 0,
+        size: int = 0,
+        skipped: int = 0,
+        rendered: int = 0,
+        failed: int = 0,
+    ):
+        with self._lock:
+            self.files += files
+            self.bytes += size
+            self.skipped += skipped
+            self.rendered += rendered
+            self.failed += failed
+            if time.monotonic() - self.logged_at >= self.interval:
+                self.logged_at = time.monotonic()
+                logging.info(self.summary())
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        return (
+            f"{self.files} files ({self.bytes / 2**20:.1f} MiB) in {elapsed:.0f}s: "
+            f"{self.files / elapsed:.1f} files/s, {self.bytes / 2**20 / elapsed:.1f} MiB/s, "
+            f"{self.skipped} skipped, {self.rendered} rendered, {self.failed} failed"
+        )
+
+
+class Journal:
+    """Append-only record of imported paths, used to resume an import."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self) -> Set[str]:
+        try:
+            with open(self.path, newline="") as f:
+                return {row[0] for row in csv.reader(f) if row}
+        except FileNotFoundError:
+            return set()
+
+    def record(self, rows: List[Tuple[str, str]]):
+        with self._lock, open(self.path, "a", newline="") as f:
+            csv.writer(f).writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def sniff(path: str) -> Optional[FileType]:
+    with open(path, "rb") as f:
+        head = f.read(SNIFF_LENGTH)
+    for magic, file_type in MAGIC_BYTES:
+        if head.startswith(magic):
+            return file_type
+    return None
+
+
+def list_paths(root: str, manifest: Optional[str]) -> Iterator[Tuple[str, str]]:
+    """Yield (path, file_name) pairs in a stable order.
+
+    A manifest is a CSV of paths relative to root, optionally followed by the
+    file name to store.
+    """
+    if manifest:
+        with open(manifest, newline="") as f:
+            for row in csv.reader(f):
+                if row and not row[0].startswith("#"):
+                    path = os.path.join(root, row[0])
+                    yield path, row[1] if len(row) > 1 else os.path.basename(path)
+        return
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        for name in sorted(files):
+            yield os.path.join(directory, name), name
+
+
+def find_files(
+    root: str, manifest: Optional[str], done: Set[str], progress: Progress
+) -> Iterator[IngestFile]:
+    for path, file_name in list_paths(root, manifest):
+        if path in done:
+            continue
+        try:
+            file_type = sniff(path)
+            size = os.path.getsize(path)
+        except OSError:
+            logging.warning(f"skipping unreadable {path}")
+            file_type = None
+        if file_type is None:
+            progress.add(skipped=1)
+            continue
+        yield IngestFile(path=path, file_name=file_name, file_type=file_type, size=size)
+
+
+def batches(
+    files: Iterator[IngestFile], batch_size: int, max_batch_bytes: int
+) -> Iterator[List[IngestFile]]:
+    batch, batch_bytes = [], 0
+    for file in files:
+        if batch and (
+            len(batch) >= batch_size or batch_bytes + file.size > max_batch_bytes
+        ):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(file)
+        batch_bytes += file.size
+    if batch:
+        yield batch
+
+
+def insert_batch(batch: List[IngestFile], progress: Progress) -> List[Tuple[str, str]]:
+    """Insert a batch in one transaction, return (path, id) of the inserted rows."""
+    rows, paths = [], []
+    for file in batch:
+        with open(file.path, "rb") as f:
+            raw_file = f.read()
+        rows.append(
+            {
+                "id": string_uuid(),
+                "file_name": file.file_name,
+                "file_type": file.file_type,
+                "raw_file": raw_file,
+                "content_hash": content_hash(raw_file),
+            }
+        )
+        paths.append(file.path)
+
+    with db_instance.engine.begin() as conn:
+        quarantined = set(
+            conn.execute(
+                select(QuarantinedFile.id).where(
+                    QuarantinedFile.id.in_([row["content_hash"] for row in rows]),
+                    QuarantinedFile.quarantined.is_(True),
+                )
+            ).scalars()
+        )
+        inserted = [
+            (path, row)
+            for path, row in zip(paths, rows)
+            if row["content_hash"] not in quarantined
+        ]
+        if inserted:
+            # psycopg2 sends this as multi-row VALUES statements
+            conn.execute(insert(MediaInfo.__table__), [row for _, row in inserted])
+    progress.add(
+        files=len(inserted),
+        size=sum(len(row["raw_file"]) for _, row in inserted),
+        skipped=len(batch) - len(inserted),
+    )
+    return [(path, row["id"]) for path, row in inserted]
+
+
+def publish_batch(ids: List[str]):
+    from app.workers.publisher import TaskMessage, task_publisher
+    from app.workers.tasks import process_raw_file
+
+    task_publisher.publish_blocking(
+        [TaskMessage(name=process_raw_file.name, args=[id]) for id in ids]
+    )
+
+
+def render_inline(id: str) -> str:
+    """Render previews and full resolution pages in a pool process."""
+    db_instance.reads_from_replicas = False
+    media_info = MediaInfo.get_or_404(id=id)
+    media_info.process_preview()
+    media_info.process_file()
+    return id
+
+
+def ingest(args) -> Progress:
+    db_instance.reads_from_replicas = False
+    journal = Journal(args.checkpoint)
+    done = journal.load()
+    if done:
+        logging.info(f"resuming, {len(done)} files already imported")
+    progress = Progress(args.report_interval)
+    writers = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="ingest")
+    renderers = (
+        ProcessPoolExecutor(
+            max_workers=args.render_processes, mp_context=get_context("spawn")
+        )
+        if args.process == "inline"
+        else None
+    )
+    in_flight: Dict[Future, List[IngestFile]] = {}
+    renders: Set[Future] = set()
+
+    def _import(batch: List[IngestFile]) -> List[str]:
+        imported = insert_batch(batch, progress)
+        ids = [id for _, id in imported]
+        if ids and args.process == "publish":
+            try:
+                publish_batch(ids)
+            except Exception as exc:
+                # the rows are committed, importing them again would duplicate them
+                journal.record(imported)
+                raise RuntimeError(f"queueing processing of {ids} failed") from exc
+        journal.record(imported)
+        return ids
+
+    def _rendered(id: str, future: Future):
+        if future.exception() is not None:
+            logging.error(f"rendering {id} failed: {future.exception()!r}")
+            progress.add(failed=1)
+        else:
+            progress.add(rendered=1)
+
+    def _collect(return_when=FIRST_COMPLETED):
+        finished, _ = wait(in_flight, return_when=return_when)
+        for future in finished:
+            batch = in_flight.pop(future)
+            try:
+                ids = future.result()
+            except Exception:
+                logging.exception(
+                    f"importing a batch of {len(batch)} files failed: "
+                    + ", ".join(file.path for file in batch)
+                )
+                progress.add(failed=len(batch))
+                continue
+            for id in ids if renderers else []:
+                render = renderers.submit(render_inline, id)
+                render.add_done_callback(lambda future, id=id: _rendered(id, future))
+                renders.add(render)
+
+    try:
+        files = find_files(args.root, args.manifest, done, progress)
+        for batch in batches(files, args.batch_size, args.max_batch_bytes):
+            # a bounded number of batches is held in memory at a time
+            if len(in_flight) >= args.workers * 2:
+                _collect()
+            in_flight[writers.submit(_import, batch)] = batch
+            if renderers and len(renders) >= args.render_processes * 4:
+                renders = wait(renders, return_when=FIRST_COMPLETED).not_done
+        _collect(return_when=ALL_COMPLETED)
+        wait(renders)
+    finally:
+        writers.shutdown(cancel_futures=True)
+        if renderers:
+            renderers.shutdown(cancel_futures=True)
+    return progress
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "root", help="directory to import, or that manifest paths are relative to"
+    )
+    parser.add_argument(
+        "--manifest", help="CSV of paths (and optional file names) to import"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="database writer threads"
+    )
+    parser.add_argument("--batch-size", type=int, default=50, help="rows per INSERT")
+    parser.add_argument(
+        "--max-batch-bytes",
+        type=int,
+        default=64 * 2**20,
+        help="file bytes per INSERT",
+    )
+    parser.add_argument(
+        "--process",
+        choices=["publish", "inline", "none"],
+        # the local task backend lives in the web process, nothing consumes
+        # what this process would publish
+        default="inline" if TASK_BACKEND == "local" else "publish",
+    )
+    parser.add_argument("--render-processes", type=int, default=os.cpu_count())
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--report-interval", type=float, default=10)
+    args = parser.parse_args()
+    if args.process == "publish" and TASK_BACKEND == "local":
+        parser.error("--process publish needs the celery task backend, use inline")
+
+    progress = ingest(args)
+    logging.info(f"done: {progress.summary()}")
+    if progress.failed:
+        logging.error(
+            f"{progress.failed} file(s) failed, see above; batches that failed to "
+            "import are retried when run again with the same checkpoint"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
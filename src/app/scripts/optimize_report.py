@@ -0,0 +1,71 @@
+"""Page size optimization report.
+
+Usage:
+    python -m app.scripts.optimize_report [paths ...] [--dpi 300]
+
+Renders each document the way the worker stores its full resolution pages and
+compares the optimized pages against plain RGB PNGs at the default compression.
+Directories are searched for PDF, PNG and JPEG files, the default is the
+sample images under app/tests/images.
+"""
+import argparse
+import os
+import time
+from typing import List
+
+from app.optimize import OptimizationReport
+from app.utils import convert_img_to_png_io, convert_pdf_to_png_io
+
+DEFAULT_PATHS = [os.path.join(os.path.dirname(__file__), "..", "tests", "images")]
+EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg")
+
+
+def find_documents(paths: List[str]) -> List[str]:
+    documents = []
+    for path in paths:
+        if os.path.isfile(path):
+            documents.append(path)
+            continue
+        for root, _, files in os.walk(path):
+            documents += [
+                os.path.join(root, name)
+                for name in sorted(files)
+                if name.lower().endswith(EXTENSIONS)
+            ]
+    return documents
+
+
+def measure(path: str, dpi: int) -> OptimizationReport:
+    report = OptimizationReport(measure=True)
+    with open(path, "rb") as f:
+        content = f.read()
+    if path.lower().endswith(".pdf"):
+        convert_pdf_to_png_io(content, dpi=dpi, report=report)
+    else:
+        convert_img_to_png_io(content, report=report)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", default=DEFAULT_PATHS)
+    parser.add_argument("--dpi", type=int, default=300)
+    args = parser.parse_args()
+
+    baseline_total = stored_total = 0
+    for path in find_documents(args.paths):
+        started_at = time.perf_counter()
+        report = measure(path, args.dpi)
+        elapsed = time.perf_counter() - started_at
+        baseline_total += report.baseline_bytes or 0
+        stored_total += report.stored_bytes
+        print(f"{os.path.relpath(path)} ({elapsed:.2f}s): {report.summary()}")
+    if stored_total:
+        print(
+            f"total: {baseline_total} -> {stored_total} bytes "
+            f"({baseline_total / stored_total:.1f}x smaller)"
+        )
+
+
+if __name__ == "__main__":
+    main()
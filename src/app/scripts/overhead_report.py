@@ -0,0 +1,104 @@
+"""Import-time and per-call overhead report.
+
+Usage:
+    python -m app.scripts.overhead_report [--top 15] [--calls 100000]
+
+Measures the cold import cost of the web (`app.main`) and worker
+(`app.workers.tasks`) entrypoints in fresh interpreters, lists the slowest
+imported modules, and compares the per-call cost of a typeguard-wrapped
+classmethod against the plain one.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import timeit
+from typing import Dict, List, Tuple
+
+ENTRYPOINTS = {
+    "web": "app.main",
+    "worker": "app.workers.tasks",
+}
+HEAVY_MODULES = ["PIL", "pdf2image", "PyPDF2", "typeguard", "alembic"]
+
+
+def measure_import(
+    module: str, env: Dict[str, str]
+) -> Tuple[int, List[Tuple[int, str]]]:
+    """Return the total import time (us) of module and per-module cumulative times."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr}")
+
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        timings.append((int(cumulative), name.rstrip()))
+    total = next(t for t, name in reversed(timings) if name.strip() == module)
+    return total, timings
+
+
+def loaded_heavy_modules(module: str, env: Dict[str, str]) -> List[str]:
+    code = (
+        f"import sys, {module}; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, env=env
+    )
+    return [m for m in result.stdout.strip().split(",") if m]
+
+
+def measure_typecheck_overhead(calls: int) -> Tuple[float, float]:
+    """Return (plain, typechecked) nanoseconds per call of a classmethod."""
+    from typeguard import typechecked
+
+    class Plain:
+        @classmethod
+        def get(cls, id: str, **kwargs) -> str:
+            return id
+
+    @typechecked
+    class Checked(Plain):
+        @classmethod
+        def get(cls, id: str, **kwargs) -> str:
+            return id
+
+    plain = timeit.timeit(lambda: Plain.get("id", a=1), number=calls)
+    checked = timeit.timeit(lambda: Checked.get("id", a=1), number=calls)
+    return plain / calls * 1e9, checked / calls * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--calls", type=int, default=100000)
+    args = parser.parse_args()
+
+    for typecheck in ("true", "false"):
+        env = {**os.environ, "RUNTIME_TYPECHECK": typecheck}
+        print(f"\n## RUNTIME_TYPECHECK={typecheck}")
+        for role, module in ENTRYPOINTS.items():
+            total, timings = measure_import(module, env)
+            heavy = loaded_heavy_modules(module, env)
+            print(f"\n{role} ({module}): {total / 1000:.1f} ms")
+            print(f"  heavy modules loaded: {', '.join(heavy) or 'none'}")
+            for cumulative, name in sorted(timings, reverse=True)[: args.top]:
+                print(f"  {cumulative / 1000:9.1f} ms  {name}")
+
+    plain, checked = measure_typecheck_overhead(args.calls)
+    print("\n## per-call overhead")
+    print(f"  plain classmethod:       {plain:8.0f} ns")
+    print(f"  typechecked classmethod: {checked:8.0f} ns")
+    print(f"  overhead:                {checked - plain:8.0f} ns/call")
+
+
+if __name__ == "__main__":
+    main()
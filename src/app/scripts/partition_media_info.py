@@ -0,0 +1,185 @@
+"""Online migration of media_info to the hash partitioned table.
+
+Usage:
+    python -m app.scripts.partition_media_info copy [--batch-size 200] [--sleep 0.5]
+    python -m app.scripts.partition_media_info verify
+    python -m app.scripts.partition_media_info swap
+
+Run after the 7d3e5a9c1b20 migration, which creates media_info_partitioned and
+mirrors new writes into it (a media_info that was empty is partitioned by the
+migration itself and needs none of this). `copy` backfills existing rows in throttled
+batches, walking ids in order and checkpointing the last one so it can be
+interrupted and resumed. `swap` takes a short exclusive lock, copies any rows
+still missing, and renames the partitioned table into place; the old table is
+kept as media_info_unpartitioned.
+"""
+import argparse
+import logging
+import os
+import time
+
+from sqlalchemy import text
+
+from app.database import db_instance
+
+COLUMNS = (
+    "file_name, raw_file, file_type, processed_files, preview_files, content_hash, "
+    "blank_pages"
+)
+DEFAULT_CHECKPOINT = "/scratch/partition_media_info.checkpoint"
+
+COPY_BATCH = text(
+    f"""
+    INSERT INTO media_info_partitioned (id, {COLUMNS})
+    SELECT id::uuid, {COLUMNS} FROM media_info WHERE id = ANY(:ids)
+    ON CONFLICT (id) DO NOTHING
+    """
+)
+COPY_MISSING = text(
+    f"""
+    INSERT INTO media_info_partitioned (id, {COLUMNS})
+    SELECT m.id::uuid, {', '.join(f'm.{c}' for c in COLUMNS.split(', '))}
+    FROM media_info m
+    WHERE NOT EXISTS (SELECT 1 FROM media_info_partitioned p WHERE p.id = m.id::uuid)
+    """
+)
+
+
+def _read_checkpoint(path: str) -> str:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def _write_checkpoint(path: str, last_id: str):
+    with open(f"{path}.tmp", "w") as f:
+        f.write(last_id)
+    os.replace(f"{path}.tmp", path)
+
+
+def copy_rows(batch_size: int, sleep: float, checkpoint: str):
+    last_id = _read_checkpoint(checkpoint)
+    copied, started_at = 0, time.monotonic()
+    while True:
+        with db_instance.engine.begin() as conn:
+            ids = (
+                conn.execute(
+                    text(
+                        "SELECT id FROM media_info WHERE id > :last_id "
+                        "ORDER BY id LIMIT :batch_size"
+                    ),
+                    {"last_id": last_id, "batch_size": batch_size},
+                )
+                .scalars()
+                .all()
+            )
+            if not ids:
+                break
+            conn.execute(COPY_BATCH, {"ids": ids})
+        last_id = ids[-1]
+        _write_checkpoint(checkpoint, last_id)
+        copied += len(ids)
+        rate = copied / max(time.monotonic() - started_at, 1e-6)
+        logging.info(f"copied {copied} rows ({rate:.1f} rows/s), last id {last_id}")
+        time.sleep(sleep)
+    logging.info(f"copy finished, {copied} rows in this run")
+
+
+def count_rows(conn) -> tuple:
+    source = conn.execute(text("SELECT count(*) FROM media_info")).scalar()
+    target = conn.execute(text("SELECT count(*) FROM media_info_partitioned")).scalar()
+    return source, target
+
+
+def verify():
+    with db_instance.engine.connect() as conn:
+        source, target = count_rows(conn)
+        plan = (
+            conn.execute(
+                text(
+                    "EXPLAIN SELECT id FROM media_info_partitioned "
+                    "WHERE id = '00000000-0000-0000-0000-000000000000'"
+                )
+            )
+            .scalars()
+            .all()
+        )
+    print(f"media_info: {source} rows, media_info_partitioned: {target} rows")
+    print("lookup by id plan:")
+    print("\n".join(f"  {line}" for line in plan))
+
+
+def partitions_of(conn, table: str) -> list:
+    return (
+        conn.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = CAST(:table AS regclass) ORDER BY c.relname"
+            ),
+            {"table": table},
+        )
+        .scalars()
+        .all()
+    )
+
+
+def swap():
+    with db_instance.engine.begin() as conn:
+        conn.execute(text("LOCK TABLE media_info IN ACCESS EXCLUSIVE MODE"))
+        source, target = count_rows(conn)
+        if source != target:
+            logging.info(f"copying {source - target} missing rows under lock")
+            conn.execute(COPY_MISSING)
+            source, target = count_rows(conn)
+            if source != target:
+                raise RuntimeError(
+                    f"row counts differ after catch-up: {source} != {target}"
+                )
+        statements = [
+            "DROP TRIGGER media_info_sync_partitioned ON media_info",
+            "DROP FUNCTION media_info_sync_partitioned()",
+            "ALTER TABLE media_info RENAME TO media_info_unpartitioned",
+            "ALTER INDEX media_info_pkey RENAME TO media_info_unpartitioned_pkey",
+            "ALTER INDEX ix_media_info_content_hash "
+            "RENAME TO ix_media_info_unpartitioned_content_hash",
+            "ALTER TABLE media_info_partitioned RENAME TO media_info",
+            "ALTER INDEX media_info_partitioned_pkey RENAME TO media_info_pkey",
+            "ALTER INDEX ix_media_info_partitioned_content_hash "
+            "RENAME TO ix_media_info_content_hash",
+        ] + [
+            f"ALTER TABLE {partition} RENAME TO "
+            f"{partition.replace('media_info_partitioned_', 'media_info_', 1)}"
+            for partition in partitions_of(conn, "media_info_partitioned")
+        ]
+        for statement in statements:
+            conn.execute(text(statement))
+    logging.info("media_info is now hash partitioned")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    copy_parser = subparsers.add_parser("copy", help="backfill existing rows")
+    copy_parser.add_argument("--batch-size", type=int, default=200)
+    copy_parser.add_argument(
+        "--sleep", type=float, default=0.5, help="seconds to pause between batches"
+    )
+    copy_parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    subparsers.add_parser("verify", help="compare row counts and show pruning")
+    subparsers.add_parser("swap", help="rename the partitioned table into place")
+    args = parser.parse_args()
+
+    if args.command == "copy":
+        copy_rows(args.batch_size, args.sleep, args.checkpoint)
+    elif args.command == "verify":
+        verify()
+    else:
+        swap()
+
+
+if __name__ == "__main__":
+    main()
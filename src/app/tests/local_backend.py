@@ -0,0 +1,175 @@
+"""Queue, retries and crash isolation of the local task backend.
+
+Tasks run on real spawned process pools. They record each run as a line in a
+file, "<redelivered>" for a completed run and "started" before crashing.
+"""
+import asyncio
+import os
+import tempfile
+import time
+
+# pool processes import the database module, which needs its settings
+for name, value in {
+    "POSTGRES_USER": "postgres",
+    "POSTGRES_PASSWORD": "postgres",
+    "POSTGRES_HOST": "localhost",
+    "POSTGRES_PORT": "5432",
+    "POSTGRES_DB": "postgres",
+}.items():
+    os.environ.setdefault(name, value)
+
+from app.workers.backend import LocalBackend  # noqa: E402
+
+TIMEOUT = 60
+
+
+def _record(path: str, line: str):
+    with open(path, "a") as f:
+        f.write(f"{line}\n")
+
+
+def _runs(path: str) -> list:
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except FileNotFoundError:
+        return []
+
+
+def succeed(path: str, delay: float = 0, redelivered: bool = False):
+    time.sleep(delay)
+    _record(path, str(redelivered))
+
+
+def fail_once(path: str, redelivered: bool = False):
+    first = not _runs(path)
+    _record(path, str(redelivered))
+    if first:
+        raise ValueError("first attempt fails")
+
+
+def always_fail(path: str, redelivered: bool = False):
+    _record(path, str(redelivered))
+    raise ValueError("never works")
+
+
+def crash(path: str, redelivered: bool = False):
+    _record(path, "started")
+    os._exit(1)
+
+
+TASKS = {task.__name__: task for task in (succeed, fail_once, always_fail, crash)}
+
+
+def _backend(directory: str, **kwargs) -> LocalBackend:
+    options = dict(processes=2, max_retries=2, retry_delay=0.05)
+    return LocalBackend(TASKS, directory=directory, **{**options, **kwargs})
+
+
+async def _drained(backend: LocalBackend):
+    deadline = time.monotonic() + TIMEOUT
+    while backend._queued:
+        assert time.monotonic() < deadline, f"{backend._queued} tasks left"
+        await asyncio.sleep(0.05)
+
+
+def _run(directory: str, submissions: list, **kwargs) -> LocalBackend:
+    async def _main():
+        backend = _backend(directory, **kwargs)
+        await backend.start()
+        try:
+            for name, args in submissions:
+                await backend.submit(name, args)
+            await _drained(backend)
+        finally:
+            await backend.stop()
+        return backend
+
+    return asyncio.run(_main())
+
+
+def _failed(directory: str) -> list:
+    return os.listdir(os.path.join(directory, "failed"))
+
+
+def test_runs_queued_tasks():
+    with tempfile.TemporaryDirectory() as directory:
+        outputs = [os.path.join(directory, f"out{i}") for i in range(5)]
+        _run(directory, [("succeed", [output]) for output in outputs])
+        assert [_runs(output) for output in outputs] == [["False"]] * 5
+        assert not _failed(directory)
+        assert sorted(os.listdir(directory)) == ["failed", "lock"] + [
+            os.path.basename(output) for output in outputs
+        ]
+
+
+def test_retries_then_gives_up():
+    with tempfile.TemporaryDirectory() as directory:
+        flaky, broken = os.path.join(directory, "flaky"), os.path.join(directory, "x")
+        _run(directory, [("fail_once", [flaky]), ("always_fail", [broken])])
+        assert _runs(flaky) == ["False", "False"]
+        # the first attempt and max_retries retries
+        assert _runs(broken) == ["False"] * 3
+        assert len(_failed(directory)) == 1
+
+
+def test_crash_is_blamed_on_the_crashing_task():
+    with tempfile.TemporaryDirectory() as directory:
+        crashing = os.path.join(directory, "crash")
+        slow = os.path.join(directory, "slow")
+        _run(directory, [("succeed", [slow, 1]), ("crash", [crashing])])
+        # the task sharing the pool is run again alone and is not redelivered
+        assert _runs(slow) == ["False"]
+        # shared pool, then alone once per attempt until retries are exhausted
+        assert _runs(crashing) == ["started"] * 4
+        assert len(_failed(directory)) == 1
+
+
+def test_resumes_interrupted_tasks():
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, "out")
+
+        async def _interrupted():
+            backend = _backend(directory)
+            await backend.start()
+            await backend.submit("succeed", [output, 2])
+            while not any(name.endswith(".running") for name in os.listdir(directory)):
+                await asyncio.sleep(0.05)
+            await backend.stop()
+
+        asyncio.run(_interrupted())
+        assert [name for name in os.listdir(directory) if name.endswith(".json")]
+
+        # the interrupted run is stopped, not completed alongside its rerun
+        _run(directory, [])
+        assert _runs(output) == ["False"]
+
+
+def test_single_process_per_directory():
+    with tempfile.TemporaryDirectory() as directory:
+
+        async def _main():
+            first = _backend(directory)
+            await first.start()
+            try:
+                second = _backend(directory)
+                try:
+                    await second.start()
+                except RuntimeError:
+                    pass
+                else:
+                    raise AssertionError("a second backend started")
+            finally:
+                await first.stop()
+            await second.start()
+            await second.stop()
+
+        asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    test_runs_queued_tasks()
+    test_retries_then_gives_up()
+    test_crash_is_blamed_on_the_crashing_task()
+    test_resumes_interrupted_tasks()
+    test_single_process_per_directory()
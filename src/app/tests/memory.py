@@ -0,0 +1,101 @@
+"""Peak memory of the upload and download paths, relative to the payload size.
+
+Runs without a database: the upload side stops at the values handed to the
+driver, the download side serializes a response the way FastAPI does.
+
+The driver bind is not measured. psycopg2 quotes bytea as a hex literal (two
+bytes per byte) only once bound to a server connection, without one it falls
+back to the escape format. While it is inserted, an upload also holds that
+literal, twice its size, on top of the peak measured here.
+"""
+import asyncio
+import tracemalloc
+from types import SimpleNamespace
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.schema.media_info import CreateMediaInfo, PartialMediaInfoResponse
+from app.type import FileType
+from app.utils import content_hash
+
+PAYLOAD_SIZE = 8 * 1024 * 1024
+PAGE_COUNT = 4
+# the upload body itself is the only full copy, validation, hashing and
+# db_value share it
+MAX_UPLOAD_MULTIPLE = 1.5
+# base64 (4/3), its str decode and the JSON body are unavoidable
+MAX_DOWNLOAD_MULTIPLE = 5.5
+
+
+def _png_payload(size: int) -> bytes:
+    from io import BytesIO
+
+    from PIL import Image
+
+    output = BytesIO()
+    Image.new("RGB", (64, 64)).save(output, format="PNG")
+    # trailing bytes after IEND are ignored by decoders
+    return output.getvalue() + b"\0" * (size - output.tell())
+
+
+def _peak_during(func) -> int:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - baseline
+
+
+def test_upload_peak_memory():
+    payload = _png_payload(PAYLOAD_SIZE)
+
+    def _upload():
+        raw_file = bytes(memoryview(payload))  # stands in for UploadFile.file.read()
+        create_media_info = CreateMediaInfo(
+            file_type=FileType.PNG,
+            raw_file=raw_file,
+            file_name="page.png",
+            content_hash=content_hash(raw_file),
+        )
+        db_value = create_media_info.db_value
+        assert db_value["raw_file"] is raw_file
+
+    multiple = _peak_during(_upload) / PAYLOAD_SIZE
+    print(f"upload peak: {multiple:.2f}x payload")
+    assert multiple <= MAX_UPLOAD_MULTIPLE, multiple
+
+
+def test_download_peak_memory():
+    page_size = PAYLOAD_SIZE // PAGE_COUNT
+    media_info = SimpleNamespace(
+        id="media",
+        file_name="scan.pdf",
+        file_type=FileType.PDF,
+        raw_file=memoryview(b"\0" * page_size),
+        processed_files=[memoryview(b"\1" * page_size) for _ in range(PAGE_COUNT)],
+        preview_files=None,
+        content_hash="0" * 64,
+    )
+    field = create_response_field(name="response", type_=PartialMediaInfoResponse)
+
+    def _download():
+        response = PartialMediaInfoResponse.response_value(
+            obj=media_info, source="processed", idx=[-1]
+        )
+        content = asyncio.run(
+            serialize_response(field=field, response_content=response)
+        )
+        JSONResponse(content=content)
+
+    multiple = _peak_during(_download) / PAYLOAD_SIZE
+    print(f"download peak: {multiple:.2f}x payload")
+    assert multiple <= MAX_DOWNLOAD_MULTIPLE, multiple
+
+
+if __name__ == "__main__":
+    test_upload_peak_memory()
+    test_download_peak_memory()
@@ -0,0 +1,98 @@
+"""Page mode analysis and encoding across the image modes PIL can hand over.
+
+Only 1, L, P and RGB pages are narrowed, everything else must come back
+unchanged (same mode, same pixels).
+"""
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from app.optimize import analyze, encode_page, optimize_encoded
+
+SIZE = (256, 128)
+
+
+def _text_page(mode: str = "RGB"):
+    image = Image.new(mode, SIZE, "white")
+    draw = ImageDraw.Draw(image)
+    for y in range(16, SIZE[1] - 16, 16):
+        draw.rectangle((16, y, SIZE[0] - 16, y + 4), fill="black")
+    return image
+
+
+def _gradient(mode: str, high: int):
+    row = np.linspace(0, high, SIZE[0])
+    pixels = np.tile(row, (SIZE[1], 1))
+    dtype = {"I;16": np.uint16, "I": np.int32, "F": np.float32}.get(mode, np.uint8)
+    image = Image.fromarray(pixels.astype(dtype))
+    assert image.mode == mode
+    return image
+
+
+def _decode(buffer):
+    return Image.open(BytesIO(bytes(buffer)))
+
+
+def test_narrowed_modes():
+    colors = Image.new("RGB", SIZE, "white")
+    ImageDraw.Draw(colors).rectangle((0, 0, 127, 127), fill=(200, 30, 30))
+    noise = np.random.default_rng(0).integers(0, 256, (*SIZE[::-1], 3), np.uint8)
+    cases = [
+        (_text_page().convert("1"), "bilevel", "1"),
+        (_text_page(), "bilevel", "1"),
+        (_text_page("L"), "bilevel", "1"),
+        (_gradient("L", 255), "grayscale", "L"),
+        (_gradient("L", 255).convert("RGB"), "grayscale", "L"),
+        (colors, "palette", "P"),
+        (colors.quantize(4), "palette", "P"),
+        (Image.fromarray(noise, mode="RGB"), "color", "RGB"),
+    ]
+    for image, mode, stored_mode in cases:
+        assert analyze(image)[0] == mode, (image.mode, mode)
+        assert _decode(encode_page(image)).mode == stored_mode, (image.mode, mode)
+
+
+def test_blank_page():
+    assert analyze(Image.new("L", SIZE, 250)) == ("bilevel", True)
+    assert analyze(_text_page()) == ("bilevel", False)
+
+
+def test_other_modes_are_kept():
+    alpha = _text_page().convert("RGBA")
+    cases = [
+        alpha,
+        alpha.convert("LA"),
+        _gradient("I;16", 65535),
+        _gradient("I;16", 300),
+    ]
+    for image in cases:
+        assert analyze(image) == ("color", False), image.mode
+        stored = _decode(encode_page(image))
+        assert stored.mode == image.mode
+        assert np.array_equal(np.asarray(stored), np.asarray(image)), image.mode
+
+    # PNG cannot hold these, they are only ever analysed
+    for image in (_gradient("I", 1 << 20), _gradient("F", 1.0)):
+        assert analyze(image) == ("color", False), image.mode
+
+
+def test_uploads_kept_unless_smaller():
+    deep = _gradient("I;16", 65535)
+    buffer = BytesIO()
+    deep.save(buffer, format="PNG")
+    assert bytes(optimize_encoded(deep, buffer.getbuffer())) == buffer.getvalue()
+
+    page = _text_page()
+    buffer = BytesIO()
+    page.save(buffer, format="PNG")
+    narrowed = optimize_encoded(page, buffer.getbuffer())
+    assert len(narrowed) < len(buffer.getvalue())
+    assert _decode(narrowed).mode == "1"
+
+
+if __name__ == "__main__":
+    test_narrowed_modes()
+    test_blank_page()
+    test_other_modes_are_kept()
+    test_uploads_kept_unless_smaller()
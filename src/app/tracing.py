@@ -0,0 +1,188 @@
+"""Lightweight request tracing shared by the web and worker processes.
+
+Spans nest through a context variable and the trace context travels between
+processes in a W3C `traceparent` header, which the web tier adds to the Celery
+message headers. Finished spans of sampled traces are handed to an exporter:
+JSON lines appended to TRACE_FILE by default, or any callable named by
+TRACE_EXPORTER ("package.module:attribute").
+
+    with tracing.span("db.insert", table="media_info"):
+        ...
+"""
+import importlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterator, Optional
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file")
+TRACE_FILE = os.getenv("TRACE_FILE", "/scratch/traces.jsonl")
+TRACEPARENT_HEADER = "traceparent"
+PUBLISHED_AT_HEADER = "trace_published_at"
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    name: str
+    sampled: bool
+    start: float = field(default_factory=time.time)
+    end: Optional[float] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class FileExporter:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, span: Span):
+        record = {
+            **asdict(span),
+            "duration_ms": (span.end - span.start) * 1000,
+            "pid": os.getpid(),
+        }
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock, open(self.path, "a") as f:
+            f.write(line)
+
+
+def _load_exporter(name: str) -> Callable[[Span], None]:
+    if name == "file":
+        return FileExporter(TRACE_FILE)
+    module_name, _, attribute = name.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+_exporter: Optional[Callable[[Span], None]] = None
+
+
+def set_exporter(exporter: Callable[[Span], None]):
+    global _exporter
+    _exporter = exporter
+
+
+def _export(span: Span):
+    global _exporter
+    try:
+        if _exporter is None:
+            _exporter = _load_exporter(TRACE_EXPORTER)
+        _exporter(span)
+    except Exception:
+        logging.exception(f"failed to export span {span.name}")
+
+
+def _parse_traceparent(traceparent: Optional[str]) -> Optional[Span]:
+    try:
+        _, trace_id, span_id, flags = traceparent.split("-")
+    except (AttributeError, ValueError):
+        return None
+    return Span(
+        trace_id=trace_id,
+        span_id=span_id,
+        parent_id=None,
+        name="remote",
+        sampled=flags == "01",
+    )
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, traceparent: Optional[str] = None, **attributes) -> Iterator[Span]:
+    """Record a span, as a child of the current span or of a remote traceparent."""
+    parent = _parse_traceparent(traceparent) if traceparent else _current_span.get()
+    if parent is None:
+        trace_id = f"{random.getrandbits(128):032x}"
+        sampled = TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+    else:
+        trace_id, sampled = parent.trace_id, parent.sampled
+    current = Span(
+        trace_id=trace_id,
+        span_id=f"{random.getrandbits(64):016x}",
+        parent_id=parent.span_id if parent else None,
+        name=name,
+        sampled=sampled,
+        attributes=attributes,
+    )
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as exc:
+        current.set(error=repr(exc))
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end = time.time()
+        if sampled:
+            _export(current)
+
+
+def record_span(name: str, start: float, end: float, **attributes):
+    """Export an already measured interval, e.g. time spent waiting in a queue."""
+    parent = _current_span.get()
+    if parent is None or not parent.sampled:
+        return
+    _export(
+        Span(
+            trace_id=parent.trace_id,
+            span_id=f"{random.getrandbits(64):016x}",
+            parent_id=parent.span_id,
+            name=name,
+            sampled=True,
+            start=start,
+            end=end,
+            attributes=attributes,
+        )
+    )
+
+
+def inject() -> Dict[str, str]:
+    """Headers carrying the current trace context to another process."""
+    current = _current_span.get()
+    if current is None:
+        return {}
+    return {
+        TRACEPARENT_HEADER: current.traceparent,
+        PUBLISHED_AT_HEADER: str(time.time()),
+    }
+
+
+def task_header(request, name: str) -> Optional[str]:
+    """Read a header added with apply_async(headers=...) from a Celery task request."""
+    value = getattr(request, name, None)
+    if value is None and isinstance(getattr(request, "headers", None), dict):
+        value = request.headers.get(name)
+    return value
+
+
+@contextmanager
+def task_span(name: str, request, **attributes) -> Iterator[Span]:
+    """Continue the publisher's trace inside a Celery task, recording queue wait."""
+    with span(
+        name, traceparent=task_header(request, TRACEPARENT_HEADER), **attributes
+    ) as current:
+        if published_at := task_header(request, PUBLISHED_AT_HEADER):
+            record_span("queue.wait", float(published_at), current.start)
+        yield current
@@ -1,4 +1,5 @@
 from enum import Enum
+from io import BytesIO
 
 
 class FileType(Enum):
@@ -6,3 +7,23 @@ class FileType(Enum):
     JPEG = "JPEG"
     JPG = "JPG"
     PNG = "PNG"
+
+
+class Buffer:
+    """Pydantic field type for binary content passed by reference.
+
+    Accepts bytes, bytearray and memoryview as they are, and BytesIO through
+    getbuffer(), so file content is never copied by model validation.
+    """
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value):
+        if isinstance(value, BytesIO):
+            return value.getbuffer()
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return value
+        raise TypeError("expected a bytes-like object")
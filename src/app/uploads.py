@@ -0,0 +1,191 @@
+"""Resumable chunked uploads, in the spirit of the tus protocol.
+
+A session lives in its own directory under UPLOAD_STAGING_DIR so that every
+web worker can serve any request for it:
+
+    <staging>/<upload_id>/session.json       metadata, renamed to
+                                             session.finalizing while finalized
+    <staging>/<upload_id>/<offset>.part      received chunks, possibly overlapping
+
+Chunks may arrive in parallel and out of order. The upload offset reported to
+clients is the length of the contiguous prefix received so far.
+"""
+import json
+import os
+import shutil
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from typing import AsyncIterator, List, Tuple
+
+from fastapi import HTTPException, status
+from starlette.concurrency import run_in_threadpool
+
+from app.exceptions import BadRequest
+from app.type import FileType
+
+STAGING_DIR = os.getenv("UPLOAD_STAGING_DIR", "/scratch/uploads")
+SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+# postgres caps a field at 1 GB and psycopg2 sends bytea as a hex literal
+# twice the size of the file (plus the \x prefix), larger files cannot be stored
+STORAGE_MAX_LENGTH = (1024**3 - 4) // 2
+MAX_UPLOAD_LENGTH = min(
+    int(os.getenv("UPLOAD_MAX_LENGTH", str(STORAGE_MAX_LENGTH))), STORAGE_MAX_LENGTH
+)
+ASSEMBLED_FILE = "assembled"
+SESSION_FILE = "session.json"
+CLAIMED_SESSION_FILE = "session.finalizing"
+
+
+@dataclass
+class UploadSession:
+    id: str
+    file_type: FileType
+    file_name: str
+    length: int
+    created_at: float
+
+    @property
+    def directory(self) -> str:
+        return os.path.join(STAGING_DIR, self.id)
+
+    @property
+    def assembled_path(self) -> str:
+        return os.path.join(self.directory, ASSEMBLED_FILE)
+
+    @classmethod
+    def create(
+        cls, file_type: FileType, file_name: str, length: int
+    ) -> "UploadSession":
+        if length <= 0 or length > MAX_UPLOAD_LENGTH:
+            raise BadRequest(f"Upload-Length must be between 1 and {MAX_UPLOAD_LENGTH}")
+        expire_sessions()
+        session = cls(
+            id=str(uuid.uuid4()),
+            file_type=file_type,
+            file_name=file_name,
+            length=length,
+            created_at=time.time(),
+        )
+        os.makedirs(session.directory)
+        with open(os.path.join(session.directory, SESSION_FILE), "w") as f:
+            json.dump({**asdict(session), "file_type": file_type.value}, f)
+        return session
+
+    @classmethod
+    def get_or_404(cls, id: str) -> "UploadSession":
+        try:
+            uuid.UUID(id)
+            with open(os.path.join(STAGING_DIR, id, SESSION_FILE)) as f:
+                data = json.load(f)
+        except (ValueError, FileNotFoundError):
+            raise HTTPException(
+                detail=f"Upload session {id} not found",
+                status_code=status.HTTP_404_NOT_FOUND,
+            )
+        return cls(**{**data, "file_type": FileType(data["file_type"])})
+
+    def parts(self) -> List[Tuple[int, int, str]]:
+        """Return (offset, size, path) of every received chunk, ordered by offset."""
+        parts = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".part"):
+                continue
+            path = os.path.join(self.directory, name)
+            parts.append((int(name[: -len(".part")]), os.path.getsize(path), path))
+        return sorted(parts)
+
+    @property
+    def offset(self) -> int:
+        offset = 0
+        for part_offset, size, _ in self.parts():
+            if part_offset > offset:
+                break
+            offset = max(offset, part_offset + size)
+        return min(offset, self.length)
+
+    async def write_chunk(self, offset: int, chunks: AsyncIterator[bytes]) -> int:
+        """Stream a chunk starting at offset to disk and return the new upload offset.
+
+        Whatever was received before a client disconnect is kept, so a retry
+        only has to resend the remainder.
+        """
+        if offset < 0 or offset >= self.length:
+            raise BadRequest(f"Upload-Offset must be between 0 and {self.length - 1}")
+        part_path = os.path.join(self.directory, f"{offset:020d}.part")
+        tmp_path = f"{part_path}.{uuid.uuid4().hex}.tmp"
+        written = 0
+        # file I/O goes to the threadpool, the event loop only receives
+        f = await run_in_threadpool(open, tmp_path, "wb")
+        try:
+            async for chunk in chunks:
+                if offset + written + len(chunk) > self.length:
+                    raise BadRequest("Chunk extends past Upload-Length")
+                await run_in_threadpool(f.write, chunk)
+                written += len(chunk)
+        finally:
+            await run_in_threadpool(f.close)
+            await run_in_threadpool(self._keep_part, tmp_path, part_path, written)
+        return await run_in_threadpool(lambda: self.offset)
+
+    @staticmethod
+    def _keep_part(tmp_path: str, part_path: str, written: int):
+        # keep the longest chunk received for this offset
+        if written and (
+            not os.path.exists(part_path) or os.path.getsize(part_path) < written
+        ):
+            os.replace(tmp_path, part_path)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    def claim(self):
+        """Take the session over for finalizing, only one request can hold it."""
+        try:
+            os.rename(
+                os.path.join(self.directory, SESSION_FILE),
+                os.path.join(self.directory, CLAIMED_SESSION_FILE),
+            )
+        except FileNotFoundError:
+            raise HTTPException(
+                detail=f"Upload session {self.id} is already being finalized",
+                status_code=status.HTTP_409_CONFLICT,
+            )
+
+    def release(self):
+        """Give a claimed session back, e.g. when finalizing it failed."""
+        os.rename(
+            os.path.join(self.directory, CLAIMED_SESSION_FILE),
+            os.path.join(self.directory, SESSION_FILE),
+        )
+
+    def assemble(self) -> str:
+        """Concatenate the received chunks into a single staged file."""
+        if self.offset < self.length:
+            raise BadRequest(
+                f"Upload is incomplete, received {self.offset} of {self.length} bytes"
+            )
+        with open(self.assembled_path, "wb") as out:
+            for part_offset, size, path in self.parts():
+                if part_offset + size <= out.tell():
+                    continue
+                with open(path, "rb") as part:
+                    part.seek(out.tell() - part_offset)
+                    shutil.copyfileobj(part, out, 1024 * 1024)
+            out.truncate(self.length)
+        return self.assembled_path
+
+    def discard(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def expire_sessions():
+    if not os.path.isdir(STAGING_DIR):
+        return
+    cutoff = time.time() - SESSION_TTL
+    for name in os.listdir(STAGING_DIR):
+        path = os.path.join(STAGING_DIR, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except FileNotFoundError:
+            continue
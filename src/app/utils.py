@@ -1,12 +1,38 @@
+import hashlib
 import os
 import subprocess
 from io import BytesIO
-from typing import Callable, Union
-
-from pdf2image import convert_from_bytes
-from PIL import Image
+from typing import Callable, List, Optional, Tuple, Union
 
+from app import tracing
 from app.database import get_db_session
+from app.optimize import OptimizationReport, encode_page, optimize_encoded
+from app.type import Buffer, FileType
+from app.workers.errors import DeterministicProcessingError
+
+# Runtime type checking is useful while developing but adds a per-call cost to
+# every wrapped method, so production deployments can switch it off.
+RUNTIME_TYPECHECK = os.getenv("RUNTIME_TYPECHECK", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+PREVIEW_DPI = int(os.getenv("PREVIEW_DPI", "72"))
+PREVIEW_MAX_SIZE = int(os.getenv("PREVIEW_MAX_SIZE", "1024"))
+PREVIEW_FORMAT = os.getenv("PREVIEW_FORMAT", "PNG")
+# formats image uploads are rendered from, whatever file_type they were sent as
+# (PIL opens JPEGs from most cameras as MPO)
+IMAGE_FORMATS = ("JPEG", "MPO", "PNG")
+
+
+def typechecked(target):
+    """Apply typeguard's runtime checks unless RUNTIME_TYPECHECK is disabled."""
+    if not RUNTIME_TYPECHECK:
+        return target
+    from typeguard import typechecked as _typechecked
+
+    return _typechecked(target)
 
 
 def db_session_wrapper(func: Callable):
@@ -17,45 +43,132 @@ def db_session_wrapper(func: Callable):
     return wrapped_func
 
 
-def convert_img_to_png_io(input_image_file: Union[BytesIO, bytes]) -> BytesIO:
+def content_hash(file: Union[BytesIO, Buffer]) -> str:
+    """Fingerprint of a file's content, used to recognise repeated uploads."""
+    if isinstance(file, BytesIO):
+        file = file.getbuffer()
+    return hashlib.sha256(file).hexdigest()
+
+
+def buffer_reader(buffer: Union[BytesIO, Buffer]) -> BytesIO:
+    """File object over a buffer, sharing the underlying bytes when possible.
+
+    BytesIO only avoids a copy when it is given a bytes object, other buffers
+    are copied once.
+    """
+    if isinstance(buffer, BytesIO):
+        buffer.seek(0)
+        return buffer
+    if (
+        isinstance(buffer, memoryview)
+        and isinstance(buffer.obj, bytes)
+        and buffer.nbytes == len(buffer.obj)
+    ):
+        buffer = buffer.obj
+    return BytesIO(buffer)
+
+
+def open_image(buffer: Union[BytesIO, Buffer]):
+    """Open and decode an uploaded image, refusing content that cannot be rendered."""
+    from PIL import Image
+
+    img = Image.open(buffer_reader(buffer))
+    try:
+        if img.format not in IMAGE_FORMATS:
+            raise DeterministicProcessingError(f"unsupported image format {img.format}")
+        try:
+            img.load()
+        except OSError as exc:
+            # truncated or corrupt image data
+            raise DeterministicProcessingError(f"cannot decode image: {exc}") from exc
+    except BaseException:
+        img.close()
+        raise
+    return img
+
+
+def convert_img_to_png_io(
+    input_image_file: Union[BytesIO, Buffer],
+    report: Optional[OptimizationReport] = None,
+) -> Buffer:
+    # imaging libraries are only needed where conversion happens
+    from PIL import Image
+
     def _resize_img(max_resolution, width, height, img):
         width_scale = max_resolution[0] / width
         height_scale = max_resolution[1] / height
         scale_factor = min(width_scale, height_scale)
         new_width = int(width * scale_factor)
         img = img.resize((new_width, int(height * scale_factor)), Image.LANCZOS)
-        result = BytesIO()
-        img.save(result, format="PNG")
-        return result
+        return encode_page(img, "PNG", report)
 
-    if isinstance(input_image_file, bytes):
-        input_image_file = BytesIO(input_image_file)
+    if isinstance(input_image_file, BytesIO):
+        input_image_file = input_image_file.getbuffer()
 
     max_resolution = (3500, 3500)
-    with Image.open(input_image_file) as img:
+    with open_image(input_image_file) as img:
         width, height = img.size
         if width <= max_resolution[0] and height <= max_resolution[1]:
-            output_image_file = BytesIO(input_image_file.getvalue())
+            # small enough, stored as uploaded unless a narrower PNG is smaller
+            with tracing.span("render.optimize_page", page=1):
+                output_image_file = optimize_encoded(img, input_image_file, report)
         else:
-            output_image_file = _resize_img(max_resolution, width, height, img)
+            with tracing.span("render.encode_page", page=1, format="PNG"):
+                output_image_file = _resize_img(max_resolution, width, height, img)
     return output_image_file
 
 
-def convert_pdf_to_png_io(input_pdf_file: Union[BytesIO, bytes]) -> list:
-    if isinstance(input_pdf_file, bytes):
-        input_pdf_file = BytesIO(input_pdf_file)
+def convert_pdf_to_png_io(
+    input_pdf_file: Union[BytesIO, Buffer],
+    dpi: int = 300,
+    max_size: Tuple[int, int] = (3500, 3500),
+    format: str = "PNG",
+    report: Optional[OptimizationReport] = None,
+) -> List[Buffer]:
+    from pdf2image import convert_from_bytes
+
+    if isinstance(input_pdf_file, BytesIO):
+        input_pdf_file = input_pdf_file.getbuffer()
     png_pages = []
 
-    pdf_images = convert_from_bytes(input_pdf_file.read(), dpi=300)
+    # poppler rasterizes the whole document in one call, pdf2image writes the
+    # buffer straight to a temporary file
+    with tracing.span("render.rasterize", dpi=dpi) as span:
+        pdf_images = convert_from_bytes(input_pdf_file, dpi=dpi)
+        span.set(pages=len(pdf_images))
+    if not pdf_images:
+        raise DeterministicProcessingError("PDF has no pages")
     for page_number, pdf_image in enumerate(pdf_images, start=1):
-        pdf_image.thumbnail((3500, 3500))
-        output_image_file = BytesIO()
-        pdf_image.save(output_image_file, format="PNG")
-        png_pages.append(output_image_file)
+        with tracing.span("render.encode_page", page=page_number, format=format):
+            pdf_image.thumbnail(max_size)
+            png_pages.append(encode_page(pdf_image, format, report))
 
     return png_pages
 
 
+def convert_to_preview_io(
+    input_file: Union[BytesIO, Buffer], file_type: FileType
+) -> List[Buffer]:
+    """Render a small, quick to produce preview of every page."""
+    if file_type == FileType.PDF:
+        return convert_pdf_to_png_io(
+            input_file,
+            dpi=PREVIEW_DPI,
+            max_size=(PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE),
+            format=PREVIEW_FORMAT,
+        )
+    if isinstance(input_file, BytesIO):
+        input_file = input_file.getbuffer()
+    with open_image(input_file) as img:
+        if max(img.size) <= PREVIEW_MAX_SIZE:
+            # already preview sized, re-encoding would only make it larger
+            return [input_file]
+        # photos stay lossy, as a PNG they are several times larger than uploaded
+        format = "JPEG" if img.format in ("JPEG", "MPO") else PREVIEW_FORMAT
+        img.thumbnail((PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE))
+        return [encode_page(img, format)]
+
+
 if __name__ == "__main__":
     with open("tests/images/jpg/1.jpg", "rb") as image_file:
         image_bytes = image_file.read()
@@ -65,7 +178,7 @@ if __name__ == "__main__":
     output_image_file = convert_img_to_png_io(input_image_file)
 
     with open("tests/images/output.png", "wb") as f:
-        f.write(output_image_file.getvalue())
+        f.write(output_image_file)
 
     with open("tests/images/pdf/1.pdf", "rb") as image_file:
         image_bytes = image_file.read()
@@ -74,6 +187,6 @@ if __name__ == "__main__":
     input_pdf_file = pdf_bytesio_object
     output_png_dict = convert_pdf_to_png_io(input_pdf_file)
 
-    for key, value in output_png_dict.items():
+    for key, value in enumerate(output_png_dict):
         with open(f"tests/images/pdf/pdf_output_{key}.png", "wb") as f:
-            f.write(value.getvalue())
+            f.write(value)
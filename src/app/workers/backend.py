@@ -0,0 +1,336 @@
+"""Where background tasks run, selected with TASK_BACKEND.
+
+"celery" (default) publishes tasks to RabbitMQ for the Celery workers. "local"
+runs them inside the web process on a pool of worker processes, for single
+node deployments and load tests without a broker. Its queue is bounded and
+persisted as one file per task under LOCAL_TASK_DIR, so queued and interrupted
+tasks are picked up again after a restart. The local backend takes a lock on
+LOCAL_TASK_DIR and refuses to start when another process holds it, so there is
+a single web worker process per directory; it only serves the web process:
+bulk imports render their files themselves (bulk_ingest --process inline).
+"""
+
+import abc
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+from app.exceptions import ServiceUnavailable
+
+TASK_BACKEND = os.getenv("TASK_BACKEND", "celery")
+LOCAL_TASK_DIR = os.getenv("LOCAL_TASK_DIR", "/scratch/tasks")
+LOCAL_TASK_PROCESSES = int(os.getenv("LOCAL_TASK_PROCESSES", str(os.cpu_count() or 1)))
+LOCAL_TASK_QUEUE_SIZE = int(os.getenv("LOCAL_TASK_QUEUE_SIZE", "1000"))
+LOCAL_TASK_MAX_RETRIES = int(os.getenv("LOCAL_TASK_MAX_RETRIES", "3"))
+LOCAL_TASK_RETRY_DELAY = float(os.getenv("LOCAL_TASK_RETRY_DELAY", "5"))
+
+
+class TaskBackend(abc.ABC):
+    @abc.abstractmethod
+    async def submit(self, name: str, args: List, headers: Dict = None):
+        ...
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abc.abstractmethod
+    def status(self):
+        ...
+
+    @abc.abstractmethod
+    def queue_depth(self, queue: str) -> int:
+        """Number of tasks waiting in the queue."""
+
+
+class CeleryBackend(TaskBackend):
+    """Tasks published to the broker, see app.workers.publisher."""
+
+    def __init__(self):
+        from app.workers.publisher import task_publisher
+
+        self.publisher = task_publisher
+        self._relay: Optional[asyncio.Task] = None
+
+    async def submit(self, name: str, args: List, headers: Dict = None):
+        await self.publisher.publish(name, args=args, headers=headers)
+
+    async def start(self):
+        self._relay = asyncio.get_running_loop().create_task(
+            self.publisher.run_outbox_relay()
+        )
+
+    async def stop(self):
+        if self._relay is not None:
+            self._relay.cancel()
+
+    def status(self):
+        """Ping the Celery workers."""
+        from app.workers.celery import celery_app
+
+        if celery_response := celery_app.control.ping(timeout=0.5):
+            return celery_response
+        return "No celery tasks currently active."
+
+    def queue_depth(self, queue: str) -> int:
+        from app.workers.celery import celery_app
+
+        # a passive declare reports the message count without the management API
+        with celery_app.connection_for_read() as connection:
+            declared = connection.default_channel.queue_declare(queue, passive=True)
+        return declared.message_count
+
+
+def _init_local_worker():
+    from app import profiling
+    from app.database import db_instance
+
+    # tasks update the rows they just read, replica lag would hide them
+    db_instance.reads_from_replicas = False
+    profiling.install_signal_handler()
+
+
+def _run_local(func: Callable, args: List, headers: Dict, redelivered: bool):
+    from app import profiling, tracing
+
+    request = SimpleNamespace(headers=headers)
+    with tracing.task_span(f"task.{func.__name__}", request, args=repr(args)):
+        with profiling.task_profile(func.__name__):
+            func(*args, redelivered=redelivered)
+
+
+class LocalBackend(TaskBackend):
+    """Tasks run on a process pool of the web process, queued on disk.
+
+    Task files move from "<name>.json" (queued) to "<name>.running" while a
+    process works on them, and to "failed/" once retries are exhausted or the
+    content is quarantined. Tasks still running when the web process died are
+    run again, which is only safe while a single process uses the directory:
+    start() fails unless it gets the directory's lock.
+
+    When a pool process dies, every task running on the pool fails, but only
+    one of them took it down. Each of them is run again alone on a separate
+    single process pool, where a crash can be told apart: it is counted as a
+    redelivery, towards the quarantine threshold like a lost Celery worker.
+    """
+
+    def __init__(
+        self,
+        tasks: Dict[str, Callable],
+        directory: str = LOCAL_TASK_DIR,
+        processes: int = LOCAL_TASK_PROCESSES,
+        max_queued: int = LOCAL_TASK_QUEUE_SIZE,
+        max_retries: int = LOCAL_TASK_MAX_RETRIES,
+        retry_delay: float = LOCAL_TASK_RETRY_DELAY,
+    ):
+        self.tasks = tasks
+        self.directory = directory
+        self.processes = processes
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._isolated_executor: Optional[ProcessPoolExecutor] = None
+        self._isolation_lock: Optional[asyncio.Lock] = None
+        self._consumers: List[asyncio.Task] = []
+        self._lock_file = None
+
+    def _new_executor(self, processes: int) -> ProcessPoolExecutor:
+        # spawned processes do not inherit the web process' pooled connections
+        return ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=get_context("spawn"),
+            initializer=_init_local_worker,
+        )
+
+    def _path(self, key: str, suffix: str = ".json") -> str:
+        return os.path.join(self.directory, f"{key}{suffix}")
+
+    def _write(self, key: str, message: Dict):
+        tmp_path = self._path(key, ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(message, f)
+        os.replace(tmp_path, self._path(key))
+
+    async def submit(self, name: str, args: List, headers: Dict = None):
+        if name not in self.tasks:
+            raise ValueError(f"task {name} cannot run on the local backend")
+        if self._queued >= self.max_queued:
+            raise ServiceUnavailable(
+                "Processing queue is full, try again later",
+                retry_after=max(1, int(self.retry_delay)),
+            )
+        # keys sort in submission order, the queue is replayed in that order
+        key = f"{time.time_ns()}-{uuid.uuid4().hex}"
+        message = {"name": name, "args": args, "headers": headers or {}, "attempts": 0}
+        self._queued += 1
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._write, key, message
+            )
+        except Exception:
+            self._queued -= 1
+            raise
+        self._queue.put_nowait(key)
+
+    def _lock_directory(self):
+        lock_file = open(os.path.join(self.directory, "lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            # it would run the same task files a second time
+            raise RuntimeError(
+                f"LOCAL_TASK_DIR {self.directory} is used by another process, the "
+                "local task backend needs a single web worker (WEB_CONCURRENCY=1)"
+            ) from None
+        self._lock_file = lock_file
+
+    async def start(self):
+        os.makedirs(os.path.join(self.directory, "failed"), exist_ok=True)
+        self._lock_directory()
+        self._queue = asyncio.Queue()
+        self._isolation_lock = asyncio.Lock()
+        self._executor = self._new_executor(self.processes)
+        for file_name in sorted(os.listdir(self.directory)):
+            key, suffix = os.path.splitext(file_name)
+            if suffix == ".running":
+                # the web process died, not necessarily because of the task
+                os.replace(self._path(key, suffix), self._path(key))
+            elif suffix != ".json":
+                continue
+            self._queued += 1
+            self._queue.put_nowait(key)
+        if self._queued:
+            logging.info(f"resuming {self._queued} queued task(s)")
+        loop = asyncio.get_running_loop()
+        self._consumers = [
+            loop.create_task(self._consume()) for _ in range(self.processes)
+        ]
+
+    async def stop(self):
+        for consumer in self._consumers:
+            consumer.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        for executor in (self._executor, self._isolated_executor):
+            if executor is not None:
+                # running tasks were requeued, finishing them now would run them twice
+                for process in list(executor._processes.values()):
+                    process.terminate()
+                executor.shutdown(wait=False, cancel_futures=True)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def status(self):
+        return {"backend": "local", "queued": self._queued, "processes": self.processes}
+
+    def queue_depth(self, queue: str) -> int:
+        # a single queue, tasks are counted until they completed or failed
+        return self._queued
+
+    async def _consume(self):
+        while True:
+            key = await self._queue.get()
+            try:
+                await self._run(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # a consumer must outlive any task, or the queue would stall
+                logging.exception(f"local task {key} could not be run")
+                self._queued -= 1
+
+    async def _run(self, key: str):
+        loop = asyncio.get_running_loop()
+        os.replace(self._path(key), self._path(key, ".running"))
+        with open(self._path(key, ".running")) as f:
+            message = json.load(f)
+        call = (
+            _run_local,
+            self.tasks[message["name"]],
+            message["args"],
+            message["headers"],
+            message.get("redelivered", False),
+        )
+        isolated = message.get("isolated", False)
+        try:
+            if isolated:
+                async with self._isolation_lock:
+                    if self._isolated_executor is None:
+                        self._isolated_executor = self._new_executor(1)
+                    executor = self._isolated_executor
+                    await loop.run_in_executor(executor, *call)
+            else:
+                executor = self._executor
+                await loop.run_in_executor(executor, *call)
+        except asyncio.CancelledError:
+            # stopped, not failed, the task runs again on the next start
+            os.replace(self._path(key, ".running"), self._path(key))
+            raise
+        except BrokenProcessPool as exc:
+            if self._executor is executor:
+                self._executor = self._new_executor(self.processes)
+            if self._isolated_executor is executor:
+                self._isolated_executor = None
+            if isolated:
+                # it ran alone, its input took the process down
+                self._failed(key, message, exc, redelivered=True)
+            else:
+                # any of the tasks sharing the pool may have, run it alone
+                self._write(key, {**message, "isolated": True})
+                os.remove(self._path(key, ".running"))
+                self._queue.put_nowait(key)
+            return
+        except Exception as exc:
+            self._failed(key, message, exc)
+            return
+        os.remove(self._path(key, ".running"))
+        self._queued -= 1
+
+    def _failed(
+        self, key: str, message: Dict, exc: BaseException, redelivered: bool = False
+    ):
+        from app.workers.errors import ContentQuarantined
+
+        attempts = message["attempts"] + 1
+        if isinstance(exc, ContentQuarantined) or attempts > self.max_retries:
+            logging.error(f"giving up on {message['name']} {message['args']}: {exc!r}")
+            os.replace(
+                self._path(key, ".running"),
+                os.path.join(self.directory, "failed", f"{key}.json"),
+            )
+            self._queued -= 1
+            return
+
+        logging.warning(f"retrying {message['name']} {message['args']}: {exc!r}")
+        self._write(key, {**message, "attempts": attempts, "redelivered": redelivered})
+        os.remove(self._path(key, ".running"))
+        delay = self.retry_delay * 2 ** (attempts - 1)
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, key)
+
+
+def create_task_backend(name: str = TASK_BACKEND) -> TaskBackend:
+    if name == "celery":
+        return CeleryBackend()
+    if name == "local":
+        from app.workers.tasks import local_tasks
+
+        return LocalBackend(local_tasks)
+    raise ValueError(f"unknown TASK_BACKEND {name!r}, expected 'celery' or 'local'")
+
+
+task_backend = create_task_backend()
@@ -0,0 +1,72 @@
+"""Classification of processing failures.
+
+Transient failures (database, broker or network hiccups) are worth retrying.
+Deterministic failures come from the input itself, a corrupt or unsupported
+file fails the same way on every attempt and is quarantined right away.
+Anything else is retried but counted towards the quarantine threshold. That
+includes running out of memory, the typical failure of a poison document, and
+the worker being lost while processing (OOM killed), which shows as a
+redelivery.
+"""
+import sys
+
+
+class DeterministicProcessingError(Exception):
+    """Raised when an input can never be processed successfully."""
+
+
+class RetryProcessing(Exception):
+    """Raised when a processing step failed and should be attempted again.
+
+    The original exception is chained as __cause__.
+    """
+
+
+class ContentQuarantined(Exception):
+    """Raised when a file's content is quarantined and must not be processed."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def is_transient(exc: BaseException) -> bool:
+    from kombu.exceptions import OperationalError as BrokerOperationalError
+    from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError
+
+    if isinstance(exc, DBAPIError) and exc.connection_invalidated:
+        return True
+    if isinstance(
+        exc,
+        (
+            OperationalError,
+            TimeoutError,
+            BrokerOperationalError,
+            ConnectionError,
+        ),
+    ):
+        return True
+    # a missing poppler install is a deployment problem, not the file's fault
+    pdf2image_exceptions = sys.modules.get("pdf2image.exceptions")
+    return pdf2image_exceptions is not None and isinstance(
+        exc, pdf2image_exceptions.PDFInfoNotInstalledError
+    )
+
+
+def is_deterministic(exc: BaseException) -> bool:
+    if isinstance(exc, DeterministicProcessingError):
+        return True
+    # imaging libraries are looked up rather than imported, an exception from
+    # them can only have been raised if they are already loaded
+    deterministic = []
+    if pil_image := sys.modules.get("PIL.Image"):
+        deterministic += [
+            pil_image.UnidentifiedImageError,
+            pil_image.DecompressionBombError,
+        ]
+    if pdf2image_exceptions := sys.modules.get("pdf2image.exceptions"):
+        deterministic += [
+            pdf2image_exceptions.PDFPageCountError,
+            pdf2image_exceptions.PDFSyntaxError,
+        ]
+    return isinstance(exc, tuple(deterministic))
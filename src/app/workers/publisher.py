@@ -0,0 +1,172 @@
+"""Publishing Celery tasks from the web tier.
+
+Publishes run on a small thread pool so the event loop never waits on AMQP
+connection setup or publisher confirms, and reuse the long-lived connections
+of the Celery producer pool. Messages can be grouped into batches sharing one
+producer. When the broker is unavailable, messages are written to the
+task_outbox table and relayed once it is back, so uploads do not stall.
+"""
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from app.workers.celery import celery_app
+
+PUBLISH_THREADS = int(os.getenv("PUBLISH_THREADS", "4"))
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", "1"))
+PUBLISH_BATCH_INTERVAL = float(os.getenv("PUBLISH_BATCH_INTERVAL_MS", "5")) / 1000
+OUTBOX_RELAY_INTERVAL = float(os.getenv("OUTBOX_RELAY_INTERVAL", "5"))
+
+# fail over to the outbox quickly instead of retrying the broker for long
+PUBLISH_RETRY_POLICY = {
+    "max_retries": 1,
+    "interval_start": 0,
+    "interval_step": 0.2,
+    "interval_max": 0.2,
+}
+
+
+@dataclass
+class TaskMessage:
+    name: str
+    args: List
+    headers: Dict[str, str] = field(default_factory=dict)
+    options: Dict = field(default_factory=dict)
+
+
+class TaskPublisher:
+    def __init__(
+        self,
+        app=celery_app,
+        threads: int = PUBLISH_THREADS,
+        batch_size: int = PUBLISH_BATCH_SIZE,
+        batch_interval: float = PUBLISH_BATCH_INTERVAL,
+    ):
+        self.app = app
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="publisher"
+        )
+        self._pending: List[tuple] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def _send(self, messages: List[TaskMessage], sent: List[TaskMessage]):
+        """Publish messages with one pooled producer.
+
+        Each message is appended to sent once the broker took it, so a caller
+        knows how far the publish got when it fails partway.
+        """
+        with self.app.producer_or_acquire() as producer:
+            for message in messages:
+                self.app.send_task(
+                    message.name,
+                    args=message.args,
+                    headers=message.headers,
+                    producer=producer,
+                    retry_policy=PUBLISH_RETRY_POLICY,
+                    **message.options,
+                )
+                sent.append(message)
+
+    def publish_blocking(self, messages: List[TaskMessage]):
+        """Publish from a worker thread, falling back to the outbox on broker errors."""
+        sent = []
+        try:
+            self._send(messages, sent)
+        except Exception:
+            # the messages the broker already took must not be relayed again
+            remaining = messages[len(sent) :]
+            logging.exception(
+                f"broker publish failed, storing {len(remaining)} message(s) "
+                "in the outbox"
+            )
+            from app.models.main import TaskOutbox
+
+            TaskOutbox.store(remaining)
+
+    async def publish(self, name: str, args: List, headers: Dict = None, **options):
+        message = TaskMessage(
+            name=name, args=args, headers=headers or {}, options=options
+        )
+        loop = asyncio.get_running_loop()
+        if self.batch_size <= 1:
+            await loop.run_in_executor(self._executor, self.publish_blocking, [message])
+            return
+
+        future = loop.create_future()
+        self._pending.append((message, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_interval, self._flush)
+        await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        def _done(publish_future):
+            for _, future in batch:
+                if future.done():
+                    continue
+                if exc := publish_future.exception():
+                    future.set_exception(exc)
+                else:
+                    future.set_result(None)
+
+        asyncio.get_running_loop().run_in_executor(
+            self._executor, self.publish_blocking, [message for message, _ in batch]
+        ).add_done_callback(_done)
+
+    def relay_outbox(self, limit: int = 100) -> int:
+        """Publish messages stored while the broker was down, return the count sent."""
+        from app.models.main import TaskOutbox
+
+        session = TaskOutbox.session()
+        sent = []
+        try:
+            rows = TaskOutbox.claim(session, limit)
+            if not rows:
+                session.commit()
+                return 0
+            try:
+                self._send(
+                    [
+                        TaskMessage(
+                            name=row.task_name,
+                            args=json.loads(row.args),
+                            headers=json.loads(row.headers),
+                            options=json.loads(row.options),
+                        )
+                        for row in rows
+                    ],
+                    sent,
+                )
+            finally:
+                # rows published before a failure are done with all the same
+                for row in rows[: len(sent)]:
+                    session.delete(row)
+                session.commit()
+            return len(sent)
+        except Exception:
+            session.rollback()
+            logging.exception("outbox relay failed, will retry")
+            return 0
+
+    async def run_outbox_relay(self, interval: float = OUTBOX_RELAY_INTERVAL):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(self._executor, self.relay_outbox)
+
+
+task_publisher = TaskPublisher()
@@ -3,8 +3,16 @@ import logging
 
 from sqlalchemy.orm import Session
 
+from app import tracing
 from app.database import get_db_session
-from app.workers.celery import BaseDbTask, celery_app, loop
+from app.utils import content_hash
+from app.workers.celery import BaseDbTask, celery_app, dead_letter_queue, loop
+from app.workers.errors import (
+    ContentQuarantined,
+    RetryProcessing,
+    is_deterministic,
+    is_transient,
+)
 
 
 async def run_async_test_task(session: Session):
@@ -33,6 +41,94 @@ def run_test_task(self):
         raise self.retry(exc=exc)
 
 
+def _dead_letter(task, id: str, reason: str):
+    """Park the message on the dead-letter queue for inspection or replay."""
+    logging.error(f"dead-lettering {task.name} for {id}: {reason}")
+    celery_app.send_task(
+        task.name,
+        args=[id],
+        queue=dead_letter_queue,
+        headers={"x-dead-letter-reason": reason},
+    )
+
+
+def run_step(id: str, step: str, media_info=None):
+    """Run a MediaInfo processing step, independent of the task backend.
+
+    The row is loaded unless the caller already holds it.
+    """
+    from app.models.main import MediaInfo
+
+    with get_db_session():
+        if media_info is None:
+            media_info = MediaInfo.get_or_404(id=id)
+        getattr(media_info, step)()
+
+
+def run_guarded(id: str, step: str, redelivered: bool = False):
+    """Run a processing step, telling transient from deterministic failures.
+
+    Raises RetryProcessing when the step should be attempted again, and
+    ContentQuarantined when the file's content is, or just became, quarantined.
+    Deterministic failures, and inputs that keep taking the worker down with
+    them (redelivered), quarantine the file's content hash.
+    """
+    from app.models.main import MediaInfo, QuarantinedFile
+
+    try:
+        media_info = MediaInfo.get_or_404(id=id)
+        file_hash = media_info.content_hash or content_hash(media_info.raw_file)
+        if redelivered:
+            QuarantinedFile.record_failure(
+                file_hash, id, "worker lost while processing"
+            )
+        quarantined = QuarantinedFile.is_quarantined(file_hash)
+    except Exception as exc:
+        logging.exception("exception while running task. retrying")
+        raise RetryProcessing() from exc
+    if quarantined:
+        raise ContentQuarantined("content is quarantined")
+
+    try:
+        # the row was loaded above, the file is not fetched a second time
+        run_step(id, step, media_info)
+    except Exception as exc:
+        if is_transient(exc):
+            logging.exception("transient exception while running task. retrying")
+            raise RetryProcessing() from exc
+        if QuarantinedFile.record_failure(
+            file_hash, id, repr(exc), deterministic=is_deterministic(exc)
+        ):
+            logging.exception("exception while running task. quarantining")
+            raise ContentQuarantined(repr(exc)) from exc
+        logging.exception("exception while running task. retrying")
+        raise RetryProcessing() from exc
+
+
+def process_media(id: str, redelivered: bool = False):
+    """Render the preview and the full resolution pass in one go.
+
+    Entry point of backends without a broker, which run both passes on the
+    same process pool.
+    """
+    run_guarded(id, "process_preview", redelivered)
+    run_guarded(id, "process_file")
+
+
+def _run_guarded(task, id: str, step: str) -> bool:
+    """run_guarded for a Celery task, return True when the step succeeded."""
+    # acks_late redelivers the message when the worker died while processing it
+    redelivered = bool((task.request.delivery_info or {}).get("redelivered"))
+    try:
+        run_guarded(id, step, redelivered)
+    except RetryProcessing as exc:
+        raise task.retry(exc=exc.__cause__)
+    except ContentQuarantined as exc:
+        _dead_letter(task, id, exc.reason)
+        return False
+    return True
+
+
 @celery_app.task(
     bind=True,
     max_retries=3,
@@ -44,15 +140,28 @@ def run_test_task(self):
     reject_on_worker_lost=True,
 )
 def process_raw_file(self, id: str):
-    async def _process_file(id: str):
-        from app.models.main import MediaInfo
+    """Render the quick preview pass, then queue the full resolution pass."""
+    with tracing.task_span("task.process_raw_file", self.request, media_id=id):
+        if not _run_guarded(self, id, "process_preview"):
+            return
+        with tracing.span("broker.publish", task="render_full_resolution"):
+            render_full_resolution.apply_async(args=[id], headers=tracing.inject())
 
-        with get_db_session() as session:
-            media_info = MediaInfo.get_or_404(id=id)
-            media_info.process_file()
 
-    try:
-        loop.run_until_complete(_process_file(id))
-    except Exception as exc:
-        logging.exception("exception while running task. retrying")
-        raise self.retry(exc=exc)
+@celery_app.task(
+    bind=True,
+    max_retries=3,
+    acks_late=True,
+    base=BaseDbTask,
+    retry_jitter=True,
+    retry_backoff=True,
+    default_retry_delay=5,
+    reject_on_worker_lost=True,
+)
+def render_full_resolution(self, id: str):
+    with tracing.task_span("task.render_full_resolution", self.request, media_id=id):
+        _run_guarded(self, id, "process_file")
+
+
+# what the local task backend runs for the tasks published by the web tier
+local_tasks = {process_raw_file.name: process_media}